@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""
+peak_rss.py <report file> <script> [script arguments]
+
+Runs a script from bin/ as though it had been run directly, then writes the peak RSS
+of the process (in MiB) to the report file, even if the script fails.
+
+run_benchmarks.py runs every script through this, because the resource usage the parent
+gets for a child (wait4, RUSAGE_CHILDREN) starts from the parent's own peak on Linux, so
+it says more about the benchmark than the script. Processes the script starts itself
+(e.g. extract_control.py --cpus) aren't counted.
+"""
+
+import os
+import runpy
+import sys
+
+
+def main():
+    """Main CLI entry point for peak_rss.py"""
+    report, script = sys.argv[1], sys.argv[2]
+    sys.argv = [script] + sys.argv[3:]
+    # the same as running the script directly: its own folder comes first on the path
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    import metrics
+
+    try:
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        with open(report, "w") as report_file:
+            report_file.write(f"{metrics.peak_rss_mib()}\n")
+
+if __name__ == '__main__':
+    main()
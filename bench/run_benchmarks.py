@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+run_benchmarks.py --records 10 1000 100000 [--json results.json]
+
+Times the scripts in bin/ on synthetic data (see synthetic.py) at each of the given
+scales, and checks that they still produce the expected output. For each scale:
+    + Each script is run end to end as its own process, for wall time and peak RSS
+        (measured inside that process, by peak_rss.py).
+    + The main functions inside each script are timed in this process, and then run
+        again under tracemalloc for their peak memory.
+    + Every output is compared to the expected output, and any difference fails the run.
+
+Anything that changes which region gets extracted shows up as a failure, not just a
+change in speed.
+"""
+
+import argparse
+import filecmp
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from typing import Callable, Dict, List
+
+import synthetic
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BIN_DIR = os.path.join(BENCH_DIR, os.pardir, "bin")
+# runs a script, and reports its own peak RSS
+PEAK_RSS = os.path.join(BENCH_DIR, "peak_rss.py")
+sys.path.insert(0, BIN_DIR)
+
+import bind_gff_to_fasta # noqa: E402 (needs bin/ on the path)
+import extract_control # noqa: E402
+import mast_xml_to_gff # noqa: E402
+
+
+def run_script(args: List[str]) -> Dict[str, float]:
+    """
+    Runs a script from bin/ in its own process, through peak_rss.py.
+
+    Returns:
+        the wall time (s) and peak RSS (MiB) of the process
+    """
+    with tempfile.NamedTemporaryFile("r", suffix=".rss") as report:
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, PEAK_RSS, report.name, os.path.join(BIN_DIR, args[0])] + args[1:])
+        wall = time.perf_counter() - start
+        if proc.returncode != 0:
+            raise RuntimeError(f"{args[0]} failed with status {proc.returncode}")
+        return {"wall_s": wall, "peak_rss_mib": float(report.read())}
+
+def measure(func: Callable[[], object]) -> Dict[str, float]:
+    """
+    Times a function, then runs it again to find its peak traced memory.
+
+    Returns:
+        the wall time (s) and peak Python memory (MiB)
+    """
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall_s": wall, "peak_traced_mib": peak / 2**20}
+
+def check(name: str, got: str, expected: str, failures: List[str]):
+    """Compares an output file to the expected file, and notes it if they're different."""
+    if not filecmp.cmp(got, expected, shallow=False):
+        failures.append(f"{name}: {got} doesn't match {expected}")
+
+def bench_scale(n_records: int, seq_len: int, workdir: str, cpus: int) -> Dict[str, object]:
+    """
+    Runs every benchmark at one scale.
+
+    Returns:
+        the results, and a list of failed output checks
+    """
+    data = synthetic.generate(os.path.join(workdir, f"data_{n_records}"), n_records, seq_len)
+    out = os.path.join(workdir, f"out_{n_records}")
+    os.makedirs(out, exist_ok=True)
+    control = os.path.join(out, "all_sequences.fasta")
+    annotations = os.path.join(out, "annotations.gff")
+    ann_seq = os.path.join(out, "annSeq.gff")
+    fused_annotations = os.path.join(out, "fused_annotations.gff")
+    fused_ann_seq = os.path.join(out, "fused_annSeq.gff")
+    parallel_annotations = os.path.join(out, "parallel_annotations.gff")
+    bound_ann_seq = os.path.join(out, "bound_annSeq.gff")
+
+    failures: List[str] = []
+    results: Dict[str, object] = {"records": n_records, "seq_len": seq_len}
+
+    # end to end, just like main.nf runs them
+    results["end_to_end"] = {
+        "extract_control": run_script(["extract_control.py", "--input", data["gff"], "--output", control,
+                                       "--cpus", str(cpus), "--force"]),
+        "mast_xml_to_gff": run_script(["mast_xml_to_gff.py", "--input", data["mast"], "--output", annotations, "--force"]),
+        "mast_xml_to_gff --cpus": run_script(["mast_xml_to_gff.py", "--input", data["mast"], "--output", parallel_annotations,
+                                              "--cpus", str(max(cpus, 2)), "--force"]),
+        "bind_gff_to_fasta": run_script(["bind_gff_to_fasta.py", "--gff", annotations, "--fasta", control,
+                                         "--output", ann_seq, "--force"]),
+        # both of the last two at once, the way main.nf runs them
+        "mast_xml_to_gff --fasta": run_script(["mast_xml_to_gff.py", "--input", data["mast"], "--output", fused_annotations,
+                                               "--fasta", control, "--bound-output", fused_ann_seq, "--force"]),
+    }
+    check("extract_control", control, data["expected_control"], failures)
+    check("mast_xml_to_gff", annotations, data["expected_annotations"], failures)
+    check("mast_xml_to_gff --cpus", parallel_annotations, data["expected_annotations"], failures)
+    check("bind_gff_to_fasta", ann_seq, data["expected_annseq"], failures)
+    check("mast_xml_to_gff --fasta", fused_annotations, data["expected_annotations"], failures)
+    check("mast_xml_to_gff --fasta", fused_ann_seq, data["expected_annseq"], failures)
+
+    # the pieces, in this process
+    profiles = [extract_control.CONTROL_REGION]
+    products = extract_control.wanted_products(profiles)
+    records = list(extract_control.read_gff_file(data["gff"], products))
+
+    # the per-record steps of join_regions, on their own
+    profile = profiles[0]
+    indexes = [extract_control.CircularIndex(len(rec), rec.features) for rec in records]
+    anchors = [extract_control.find_anchor(profile.bound_start_anchor, index) for index in indexes]
+
+    def find_bounds():
+        return [(extract_control.find_bound(index, profile.bound_start, anchor),
+                 extract_control.find_bound(index, profile.bound_end, None))
+                for index, anchor in zip(indexes, anchors)]
+
+    bounds = find_bounds()
+
+    def write_mast():
+        mast_xml_to_gff.write_gff(mast_xml_to_gff.iter_mast_hits(data["mast"]), io.StringIO())
+
+    results["functions"] = {
+        "extract_control.index_gff": measure(lambda: extract_control.index_gff(data["gff"])),
+        "extract_control.read_gff_file": measure(lambda: list(extract_control.read_gff_file(data["gff"], products))),
+        "extract_control.find_anchor": measure(lambda: [extract_control.find_anchor(profile.bound_start_anchor, index)
+                                                        for index in indexes]),
+        "extract_control.find_bound": measure(find_bounds),
+        "extract_control.parse_seq": measure(lambda: [extract_control.parse_seq(rec, start, end, profile.bound_end_strand)
+                                                      for rec, (start, end) in zip(records, bounds)]),
+        "extract_control.join_regions": measure(lambda: extract_control.join_regions(records, profiles)),
+        "mast_xml_to_gff.iter_mast_hits": measure(lambda: list(mast_xml_to_gff.iter_mast_hits(data["mast"]))),
+        "mast_xml_to_gff.write_gff": measure(write_mast),
+        "mast_xml_to_gff.scan_mast_xml": measure(lambda: mast_xml_to_gff.scan_mast_xml(data["mast"], cpus * 4)),
+        "bind_gff_to_fasta.main": measure(lambda: bind_gff_to_fasta.main(["--gff", annotations, "--fasta", control,
+                                                                          "--output", bound_ann_seq, "--force"])),
+    }
+    check("bind_gff_to_fasta.main", bound_ann_seq, data["expected_annseq"], failures)
+
+    # the in-process results have to match as well
+    with open(data["expected_control"]) as expected_file:
+        if extract_control.join_regions(records, profiles)[0] != expected_file.read():
+            failures.append("extract_control.join_regions: doesn't match the expected control regions")
+    del records, indexes, bounds
+
+    results["failures"] = failures
+    return results
+
+def print_results(results: Dict[str, object]):
+    """Prints one scale's results as a table."""
+    print(f"\n== {results['records']} records ({results['seq_len']} nt each) ==")
+    for section in ("end_to_end", "functions"):
+        for name, stats in results[section].items():
+            cols = "  ".join(f"{key}={value:.3f}" for key, value in stats.items())
+            print(f"  {name:<34} {cols}")
+    for failure in results["failures"]:
+        print(f"  FAILED: {failure}")
+
+def main():
+    """Main CLI entry point for run_benchmarks.py"""
+    parser = argparse.ArgumentParser(description="Benchmarks the bin/ scripts on synthetic data, and checks their output.")
+    parser.add_argument("--records", type=int, nargs="+", default=[10, 1000], help="The numbers of genomes to benchmark with.")
+    parser.add_argument("--length", type=int, default=16000, help="The length of each genome.")
+    parser.add_argument("--cpus", type=int, default=1, help="Passed on to extract_control.py.")
+    parser.add_argument("--workdir", help="Where to put the data and outputs. Defaults to a temporary folder.")
+    parser.add_argument("--json", help="Also write the results to this file, as JSON.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        all_results = []
+        for n_records in args.records:
+            results = bench_scale(n_records, args.length, workdir, args.cpus)
+            print_results(results)
+            all_results.append(results)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(all_results, json_file, indent=2)
+
+    if any(results["failures"] for results in all_results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""
+synthetic.py --records <n> --outdir <folder>
+
+Makes synthetic test data for the scripts in bin/, along with the output they
+should produce:
+    + mitogenomes.gff: Prokka-style GFF with a ##FASTA section. The records cycle
+        through the four orientations extract_control.py handles (normal, reverse
+        complement, rotated, rotated reverse complement), and through these cases:
+            - two_ile: a second copy of the Ile-tRNA away from ND2, so the anchor has
+                to be used to pick the right one.
+            - 12s_origin, ile_origin: the origin is inside the 12S rRNA or the Ile-tRNA,
+                so that boundary is split across the start/end of the sequence.
+            - no_nd2: there's no ND2, so the 12S rRNA is the anchor for picking between
+                the two Ile-tRNAs.
+    + expected_control.fasta: the control region of every record.
+    + mast.xml: MAST output with random motif hits on the control regions.
+    + expected_annotations.gff: what mast_xml_to_gff.py should make of mast.xml.
+    + expected_annSeq.gff: what bind_gff_to_fasta.py should make of the two.
+
+Everything is generated from a seed, so the same arguments always make the same files.
+"""
+
+import argparse
+import os
+import random
+import shutil
+
+from typing import List, Tuple
+
+# base -> complement, for reverse complementing
+COMPLEMENT = bytes.maketrans(b"ACGT", b"TGCA")
+# any byte -> a base
+BASES = bytes(b"ACGT"[i % 4] for i in range(256))
+
+ORIENTATIONS = ["normal", "rev_comp", "rotated", "rotated_rev_comp"]
+CASES = ["two_ile", "12s_origin", "ile_origin", "no_nd2"]
+
+ND2 = "NADH-ubiquinone oxidoreductase chain 2"
+
+# (start, end, strand, type, product) in the normal orientation, 1 indexed like GFF.
+# Everything that isn't fixed is relative to the genome length, L.
+def layout(seq_len: int) -> List[Tuple[int, int, str, str, str]]:
+    """The features of a genome in the normal orientation."""
+    half = seq_len // 2
+    return [
+        (200, 268, "+", "tRNA", "mtRNA-Ile(gat)"),
+        (300, 370, "-", "tRNA", "mtRNA-Gln(ttg)"),
+        (380, 448, "+", "tRNA", "mtRNA-Met(cat)"),
+        (500, 1520, "+", "CDS", ND2),
+        (1600, 3135, "+", "CDS", "Cytochrome c oxidase subunit 1"),
+        (half, half + 68, "+", "tRNA", "mtRNA-Ile(gat)"), # the decoy: same product, nowhere near ND2
+        (seq_len - 2900, seq_len - 1600, "-", "rRNA", "16S ribosomal RNA"),
+        (seq_len - 1500, seq_len - 700, "-", "rRNA", "12S ribosomal RNA"),
+    ]
+
+def control_region(seq: bytes) -> bytes:
+    """The control region of a genome in the normal orientation: after the 12S rRNA, around to the Ile-tRNA."""
+    return seq[len(seq) - 700:] + seq[:199]
+
+def rotate(seq: bytes, feats: list, offset: int) -> Tuple[bytes, list]:
+    """Moves the origin `offset` bases along. Features that end up across the origin get end < start."""
+    seq_len = len(seq)
+    return (seq[offset:] + seq[:offset],
+            [((start - 1 - offset) % seq_len + 1, (end - 1 - offset) % seq_len + 1, strand, ftype, prod)
+             for start, end, strand, ftype, prod in feats])
+
+def rev_comp(seq: bytes, feats: list) -> Tuple[bytes, list]:
+    """Reverse complements a genome and its features."""
+    seq_len = len(seq)
+    return (seq.translate(COMPLEMENT)[::-1],
+            [(seq_len - end + 1, seq_len - start + 1, "-" if strand == "+" else "+", ftype, prod)
+             for start, end, strand, ftype, prod in feats])
+
+def make_genome(rng: random.Random, index: int, seq_len: int) -> Tuple[bytes, list, bytes]:
+    """
+    Makes one genome.
+
+    Returns:
+        (sequence, features, control region in the normal orientation)
+    """
+    seq = rng.getrandbits(8 * seq_len).to_bytes(seq_len, "little").translate(BASES)
+    feats = layout(seq_len)
+    expected = control_region(seq)
+
+    orientation, case = genome_case(index)
+    if case == "no_nd2":
+        feats = [feat for feat in feats if feat[4] != ND2]
+
+    if case in ("12s_origin", "ile_origin"):
+        # somewhere inside the feature, so it ends up with end < start. This replaces the
+        # rotation of the rotated orientations: the origin can only be in one place.
+        start, end = next((f[0], f[1]) for f in feats if f[4] == ("12S ribosomal RNA" if case == "12s_origin" else "mtRNA-Ile(gat)"))
+        seq, feats = rotate(seq, feats, rng.randint(start, end - 1))
+    elif orientation.startswith("rotated"):
+        # anywhere between the ND2 and the 12S, so the 12S comes first
+        seq, feats = rotate(seq, feats, rng.randint(1600, seq_len - 1600))
+    if orientation.endswith("rev_comp"):
+        seq, feats = rev_comp(seq, feats)
+
+    feats.sort(key=lambda f: f[0])
+    return seq, feats, expected
+
+def genome_case(index: int) -> Tuple[str, str]:
+    """The orientation and case of a genome. Every combination comes up once in each 16 genomes."""
+    return ORIENTATIONS[index % len(ORIENTATIONS)], CASES[index // len(ORIENTATIONS) % len(CASES)]
+
+def genome_id(index: int) -> str:
+    """The sequence ID of a genome, which says which orientation and case it is."""
+    return f"syn{index}_{'_'.join(genome_case(index))}"
+
+def write_mitogenomes(n_records: int, seq_len: int, seed: int, gff_path: str, expected_path: str) -> List[Tuple[str, int]]:
+    """
+    Writes the GFF and the control regions it should give.
+
+    Returns:
+        (control region ID, length) for every record
+    """
+    rng = random.Random(seed)
+    regions = []
+    fasta_path = gff_path + ".fasta.tmp"
+
+    # Prokka puts all the ##sequence-region lines first, then the features, then the sequences,
+    # so the sequences go to a temporary file until the features are done.
+    with open(gff_path, "w") as gff_file, open(fasta_path, "w") as fasta_file, open(expected_path, "w") as expected_file:
+        gff_file.write("##gff-version 3\n")
+        for i in range(n_records):
+            gff_file.write(f"##sequence-region {genome_id(i)} 1 {seq_len}\n")
+
+        for i in range(n_records):
+            seq, feats, expected = make_genome(rng, i, seq_len)
+            seq_id = genome_id(i)
+            for j, (start, end, strand, ftype, prod) in enumerate(feats):
+                locus = f"SYN{i}_{j:05d}"
+                gff_file.write(f"{seq_id}\tProkka:1.14.0\t{ftype}\t{start}\t{end}\t.\t{strand}\t{'0' if ftype == 'CDS' else '.'}\t"
+                               f"ID={locus};inference=ab initio prediction:Prodigal:2.6;locus_tag={locus};product={prod}\n")
+
+            fasta_file.write(f">{seq_id}\n")
+            fasta_file.write("\n".join(seq[k:k + 60].decode() for k in range(0, len(seq), 60)) + "\n")
+            expected_file.write(f">{seq_id}_cont_reg\n{expected.decode()}\n")
+            regions.append((f"{seq_id}_cont_reg", len(expected)))
+
+        gff_file.write("##FASTA\n")
+        fasta_file.close()
+        with open(fasta_path) as in_file:
+            shutil.copyfileobj(in_file, gff_file)
+
+    os.remove(fasta_path)
+    return regions
+
+def write_mast(regions: List[Tuple[str, int]], seed: int, xml_path: str, expected_path: str):
+    """Writes MAST output for the control regions, and the GFF it should give."""
+    rng = random.Random(seed)
+    motifs = [(f"MOTIF{m}", rng.choice(["", f"ALT{m}"]), rng.randint(8, 25)) for m in range(8)]
+
+    with open(xml_path, "w") as xml_file, open(expected_path, "w") as expected_file:
+        xml_file.write('<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<mast version="5.0.5" release="synthetic">\n'
+                       '  <motifs source="motifs.txt" name="motifs.txt" last_mod_date="synthetic">\n')
+        for motif_id, alt, length in motifs:
+            alt_attr = f' alt="{alt}"' if alt else ""
+            xml_file.write(f'    <motif id="{motif_id}"{alt_attr} length="{length}" nsites="20" evalue="1e-10" bad="n">\n')
+            xml_file.write('      <pos A="0.25" C="0.25" G="0.25" T="0.25"/>\n' * length)
+            xml_file.write('    </motif>\n')
+        xml_file.write('  </motifs>\n  <sequences>\n')
+
+        expected_file.write("##gff-version 3\n")
+        for name, length in regions:
+            xml_file.write(f'    <sequence db="0" name="{name}" comment="" length="{length}" combined_pvalue="1e-5" evalue="0.1">\n'
+                           '      <score strand="both" combined_pvalue="1e-5" evalue="0.1"/>\n'
+                           '      <seg start="1">\n        <data>\nN\n        </data>\n')
+            expected_file.write(f"##sequence-region {name} 1 {length}\n")
+            for _ in range(rng.randint(0, 6)):
+                idx = rng.randrange(len(motifs))
+                motif_id, alt, motif_len = motifs[idx]
+                pos = rng.randint(1, max(1, length - motif_len))
+                strand = rng.choice("+-")
+                pvalue = f"{rng.uniform(1e-9, 1e-4):.2e}"
+                xml_file.write(f'        <hit idx="{idx}" rc="{"y" if strand == "-" else "n"}" pos="{pos}" pvalue="{pvalue}" match="+"/>\n')
+                full_name = f"{alt} {motif_id}" if alt else motif_id
+                expected_file.write(f"{name}\tMEME Suite\tnucleotide_motif\t{pos}\t{pos + motif_len - 1}\t.\t{strand}\t.\t"
+                                    f"Name={full_name};Note=p-value:{pvalue}\n")
+            xml_file.write('      </seg>\n    </sequence>\n')
+        xml_file.write('  </sequences>\n</mast>\n')
+
+def generate(outdir: str, n_records: int, seq_len: int = 16000, seed: int = 1) -> dict:
+    """
+    Makes a full set of synthetic data in a folder.
+
+    Args:
+        outdir: where the files go
+        n_records: the number of genomes
+        seq_len: the length of each genome
+        seed: the random seed
+    Returns:
+        a dictionary of file role -> path
+    """
+    os.makedirs(outdir, exist_ok=True)
+    paths = {role: os.path.join(outdir, name) for role, name in [
+        ("gff", "mitogenomes.gff"),
+        ("expected_control", "expected_control.fasta"),
+        ("mast", "mast.xml"),
+        ("expected_annotations", "expected_annotations.gff"),
+        ("expected_annseq", "expected_annSeq.gff"),
+    ]}
+
+    regions = write_mitogenomes(n_records, seq_len, seed, paths["gff"], paths["expected_control"])
+    write_mast(regions, seed, paths["mast"], paths["expected_annotations"])
+
+    with open(paths["expected_annseq"], "w") as out_file:
+        for part in (paths["expected_annotations"], None, paths["expected_control"]):
+            if part is None:
+                out_file.write("##FASTA\n")
+                continue
+            with open(part) as in_file:
+                out_file.write(in_file.read())
+
+    return paths
+
+def main():
+    """Main CLI entry point for synthetic.py"""
+    parser = argparse.ArgumentParser(description="Makes synthetic mitogenome GFFs and MAST output, with the expected results.")
+    parser.add_argument("--records", type=int, default=100, help="The number of genomes to make.")
+    parser.add_argument("--length", type=int, default=16000, help="The length of each genome. Must be at least 6000.")
+    parser.add_argument("--seed", type=int, default=1, help="The random seed.")
+    parser.add_argument("--outdir", default="synthetic", help="Where to put the files.")
+    args = parser.parse_args()
+
+    if args.length < 6000:
+        parser.error("--length must be at least 6000, or the features overlap.")
+    generate(args.outdir, args.records, args.length, args.seed)
+
+if __name__ == '__main__':
+    main()
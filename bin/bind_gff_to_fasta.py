@@ -3,43 +3,64 @@
 """
 bind-gff-to-fasta.py --gff [in].gff --fasta [in2].fasta > output.gff
 
-Takes a .gff file and a .fasta file and puts them together. Doesn't check if
-the .gff already has a ##FASTA section.
+Takes a .gff file and a .fasta file and puts them together. It's an error if the
+.gff already has a ##FASTA section.
+
+Any of the files can be "-" for standard input/output (the .gff and the output
+are by default, so it can go at the end of a pipe), and any of them can be
+gzipped (see streams.py). Plain files are copied by the kernel where possible.
 """
 
 import argparse
 
-def get_params():
-    """Gets the command line arguments"""
+from metrics import Metrics
+import streams
+
+from typing import Optional, Sequence
+
+# only collects anything with --metrics
+METRICS = Metrics("bind_gff_to_fasta.py")
+
+def get_params(argv: Optional[Sequence[str]] = None):
+    """Gets the command line arguments (from sys.argv, unless they're given)"""
     parser = argparse.ArgumentParser(description="""
-        Takes a .gff file and a .fasta file and puts them together. Doesn't check if
-        the .gff already has a ##FASTA section. Output is done through standard
-        output.
+        Takes a .gff file and a .fasta file and puts them together. It's an error if
+        the .gff already has a ##FASTA section.
         """.strip())
-    parser.add_argument("--gff", help="The gff file to be worked on.")
+    parser.add_argument("--gff", default="-", help="The gff file to be worked on. Defaults to standard input.")
     parser.add_argument("--fasta", help="The FASTA sequence file to be worked on. Make sure it matches the annotation file.")
-    parser.add_argument("--output", help="The destination of the output file.")
+    parser.add_argument("--output", default="-", help="The destination of the output file. Defaults to standard output.")
     parser.add_argument("--force", action="store_true", help="Overwrites the output if it already exists.")
+    parser.add_argument("--metrics", help="Append per-stage timings to this file, as JSON lines.")
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.gff == "-" and args.fasta == "-":
+        parser.error("only one of --gff and --fasta can be standard input.")
+    # a second ##FASTA section would just be appended to the first one
+    if streams.has_fasta_section(args.gff):
+        parser.error(f"{args.gff} already has a ##FASTA section.")
+    return args
 
-def main():
+def main(argv: Optional[Sequence[str]] = None):
     """
     this just prints all the contents of the .gff, then prints the ##FASTA tag, then all the fasta sequences.
     """
-    args = get_params()
+    args = get_params(argv)
+    if args.metrics:
+        METRICS.enable()
 
     # make a new file, either forcing overwrite of the old file or not, depending on the setting.
-    with open(args.output, "w" if args.force else "x") as out_file:
-        with open(args.gff) as gff_file:
-            for i in gff_file:
-                out_file.write(i)
+    with streams.open_output(args.output, args.force) as out_file:
+        with METRICS.stage("copy_gff"):
+            streams.append_input(args.gff, out_file)
 
         out_file.write("##FASTA\n")
 
-        with open(args.fasta) as fasta_file:
-            for i in fasta_file:
-                out_file.write(i)
+        with METRICS.stage("copy_fasta"):
+            streams.append_input(args.fasta, out_file)
+
+    if args.metrics:
+        METRICS.write(args.metrics)
 
 if __name__ == '__main__':
     main()
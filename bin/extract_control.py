@@ -6,8 +6,8 @@ extract-control.py --input <infile>.gff > <outfile>.fasta
 This script takes an input of a gff file (usually generated by Proka) with a
 ##FASTA section containing the sequence data, and outputs a FASTA file of all
 the control regions found. The script is capable of finding control regions in
-reverse complemented and rotated sequences, unless the feature is split across
-the start/end of the sequence.
+reverse complemented and rotated sequences, including ones where a boundary
+feature is split across the start/end of the sequence.
 
 The general process is as follows:
     + Annotations for the Ile-tRNA and 12S rRNA are located.
@@ -25,31 +25,544 @@ The general process is as follows:
 
 # Disable circular distance?
 
-# command line arguments, GFF parser
+# the Biopython types in the annotations aren't imported until they're needed (see load_libraries)
+from __future__ import annotations
+
+# command line arguments, GFF parsing
 import argparse
-from BCBio import GFF
+import bisect
+import contextlib
+import hashlib
+import importlib.util
+import json
+import mmap
+import multiprocessing
+import os
+from urllib.parse import unquote
+
+from metrics import Metrics
+import region_cache
+import streams
 
 # Type hinting
-from typing import TYPE_CHECKING, Dict, Tuple, Iterable, List, Optional
+from typing import TYPE_CHECKING, Dict, Tuple, Iterable, Iterator, List, NamedTuple, Optional, Sequence, TextIO
+
 if TYPE_CHECKING:
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
     from Bio.SeqFeature import SeqFeature, FeatureLocation
+
+# Biopython takes longer to import than a small genome takes to extract, so it's
+# only imported by load_libraries, once something needs them. --help, and runs where every
+# region comes out of the cache, never do.
+LIBRARIES_LOADED = False
+Seq = SeqRecord = SeqFeature = FeatureLocation = MappedSequenceData = None
+
+def load_libraries():
+    """Imports Biopython, the first time it's called."""
+    global LIBRARIES_LOADED, Seq, SeqRecord, SeqFeature, FeatureLocation, MappedSequenceData
+    if LIBRARIES_LOADED:
+        return
+
+    from Bio.Seq import Seq, SequenceDataAbstractBaseClass
     from Bio.SeqRecord import SeqRecord
+    from Bio.SeqFeature import SeqFeature, FeatureLocation
+
+    class MappedSequenceData(MappedSequence, SequenceDataAbstractBaseClass):
+        __slots__ = ()
+        __doc__ = MappedSequence.__doc__
+
+    LIBRARIES_LOADED = True
+
+# only collects anything with --metrics
+METRICS = Metrics("extract_control.py")
+
+# records per extract_batch call
+BATCH_SIZE = 1024
+
+# part of every cache key. Bump it whenever a change here would change what gets extracted
+# (or how it's stored), so regions cached by older versions aren't used.
+CACHE_VERSION = b"3"
+
+class BoundaryProfile(NamedTuple):
+    """The annotations that bound one region, and how to find them."""
+    name: str
+    # highest to lowest priority, e.x. 12S is preferred to 12S (partial)
+    bound_start: List[str]
+    bound_end: List[str]
+    bound_end_strand: int # 1 positive, -1 negative strand. This is used to check for the reverse complement.
+    # anchors are basically only for tRNAs as boundaries because tRNAs are easy to copy and move,
+    # and are sometimes just totally mis-annotated when done automatically.
+    # So we use a protein coding gene, preferably large so it's harder to translocate, but generally just the closest.
+    # Then we find the closest tRNA to that gene and use that.
+    # IF NO ANCHOR IS GIVEN OR FOUND, it just uses the first occurence of the highest priority bound marker
+    # start/end are relative to the orientation on the stand. The start is the beginnig of the gene, not necessarily the bfirst numbered nt
+    bound_start_anchor: List[Tuple[str, str]]
+
+# The mitogenome control region: between the Ile-tRNA and the 12S rRNA
+CONTROL_REGION = BoundaryProfile(
+    name="cont_reg",
+    bound_start=["mtRNA-Ile(gat)", "mtRNA-Ile(aat)"],
+    bound_end=["12S ribosomal RNA", "12S ribosomal RNA (partial)"],
+    bound_end_strand=-1,
+    bound_start_anchor=[("NADH-ubiquinone oxidoreductase chain 2","start"),("12S ribosomal RNA","start"), ("12S ribosomal RNA (partial)","start")]
+)
+
+class Job(NamedTuple):
+    """A unit of work for extract_job."""
+    path: str
+    shard: Optional[list] # records from index_gff, or None for all of them
+    profiles: List[BoundaryProfile]
+    cache: Optional[region_cache.RegionCache]
+    summary: bool # whether to work out the summary rows
+
+def load_profiles(path: str) -> List[BoundaryProfile]:
+    """
+    Reads boundary profiles out of a JSON file.
+
+    The file is an object of region names, each with its own boundaries, e.g.:
 
-def get_params():
-    """Returns the command line arguments."""
+        {
+            "cont_reg": {
+                "start": ["mtRNA-Ile(gat)", "mtRNA-Ile(aat)"],
+                "end": ["12S ribosomal RNA", "12S ribosomal RNA (partial)"],
+                "end_strand": -1,
+                "start_anchor": [["NADH-ubiquinone oxidoreductase chain 2", "start"]]
+            }
+        }
+
+    "end_strand" defaults to -1 and "start_anchor" defaults to no anchors.
+
+    Args:
+        path: the location of the profile file
+    Returns:
+        a list of boundary profiles, in file order
+    """
+    with open(path) as profile_file:
+        raw = json.load(profile_file)
+
+    profiles = []
+    for name, prof in raw.items():
+        if not prof.get("start") or not prof.get("end"):
+            raise ValueError(f"Profile '{name}' needs both \"start\" and \"end\" boundaries.")
+        for anch in prof.get("start_anchor", []):
+            if len(anch) != 2 or anch[1] not in ("start", "end"):
+                raise ValueError(f"Profile '{name}' has a bad anchor {anch!r}: expected [product, \"start\"/\"end\"].")
+        profiles.append(BoundaryProfile(
+            name=name,
+            bound_start=list(prof["start"]),
+            bound_end=list(prof["end"]),
+            bound_end_strand=int(prof.get("end_strand", -1)),
+            bound_start_anchor=[tuple(anch) for anch in prof.get("start_anchor", [])]
+        ))
+    return profiles
+
+def wanted_products(profiles: Iterable[BoundaryProfile]) -> List[str]:
+    """
+    Every product named in the boundaries and anchors. These are the only features ever looked at.
+
+    Args:
+        profiles: the boundary profiles
+    Returns:
+        a list of product names, normalized (see normalize_product)
+    """
+    products: List[str] = []
+    for prof in profiles:
+        products += prof.bound_start + prof.bound_end + [anch[0] for anch in prof.bound_start_anchor]
+    return [normalize_product(product) for product in products]
+
+def region_output_path(output: str, name: str) -> str:
+    """
+    Where a region goes when there's more than one: the region name before the extension.
+    Standard output stays standard output.
+
+    >>> region_output_path("out/regions.fasta", "cont_reg")
+    'out/regions_cont_reg.fasta'
+    >>> region_output_path("out/regions.fasta.gz", "cont_reg")
+    'out/regions_cont_reg.fasta.gz'
+    """
+    if output == "-":
+        return output
+    uncompressed = streams.strip_compression(output)
+    root, ext = os.path.splitext(uncompressed)
+    return f"{root}_{name}{ext}{output[len(uncompressed):]}"
+
+def get_params(argv: Optional[Sequence[str]] = None):
+    """Returns the command line arguments (from sys.argv, unless they're given)."""
 
     parser = argparse.ArgumentParser(description="""
         This script takes an input of a gff file (usually generated by Proka) with a
         ##FASTA section containing the sequence data, and outputs a FASTA file of all
         the control regions found. The script is capable of finding control regions in
-        reverse complemented and rotated sequences, unless the feature is split across
-        the start/end of the sequence. Output is done through standard output.
+        reverse complemented and rotated sequences, including ones where a boundary
+        feature is split across the start/end of the sequence.
+        """.strip())
+    parser.add_argument("--input", nargs="+", default=["-"], help="""
+        The file(s) to be worked on. GFF format with a ##FASTA section, optionally gzipped
+        or bgzipped. "-" (the default) is standard input. All the control regions are written
+        to the same output, in input order. Standard input and compressed files are read
+        as a stream, one record at a time, so they aren't split up between processes or cached.
+        """.strip())
+    parser.add_argument("--output", default="-", help="""
+        The destination of the output file. "-" (the default) is standard output. Ending it
+        in .gz or .bgz compresses it.
+        """.strip())
+    parser.add_argument("--profiles", help="""
+        JSON file of named regions to extract, each with its own boundaries and anchors.
+        Every region is found in the same pass over the input. With more than one region,
+        each one is written to its own file, named after the output and the region.
+        Defaults to just the control region.
+        """.strip())
+    parser.add_argument("--summary", help="""
+        Also write a table with a row for every region in every record: the boundary
+        features and anchor that were used, the orientation, the bounds, and whether a
+        boundary is missing. Tab separated, or Parquet if it ends in .parquet (needs pyarrow).
+        """.strip())
+    parser.add_argument("--unique", help="""
+        Also write just one of each distinct region sequence here (the first one found),
+        e.g. to search with MAST. Needs --members.
+        """.strip())
+    parser.add_argument("--members", help="""
+        With --unique, write which representative in --unique each region's sequence is,
+        as a table of representative and member names (see mast_xml_to_gff.py --members).
+        """.strip())
+    parser.add_argument("--metrics", help="""
+        Append per-stage timings and per-record counters to this file, as JSON lines.
+        """.strip())
+    parser.add_argument("--cache", help="""
+        Folder to cache extracted regions in. Records that haven't changed since they were
+        last extracted (with the same profiles) are taken from the cache without being parsed.
+        The folder can be shared by any number of runs at once.
+        """.strip())
+    parser.add_argument("--cache-size", type=int, default=1024, help="""
+        The most the cache can hold, in MiB. The least recently used regions are evicted
+        at the end of each run to get under it. Defaults to 1024.
+        """.strip())
+    parser.add_argument("--cpus", type=int, default=1, help="""
+        Number of worker processes. Many inputs are split up by file; one or a few
+        multi-record inputs (e.g. chunks of genomes) are split up by record.
         """.strip())
-    parser.add_argument("--input", help="The file to be worked on. GFF format with a ##FASTA section.")
-    parser.add_argument("--output", help="The destination of the output file.")
     parser.add_argument("--force", action="store_true", help="Overwrites the output if it already exists.")
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if bool(args.unique) != bool(args.members):
+        parser.error("--unique and --members go together.")
+    # before any of the outputs are created, so a missing pyarrow doesn't leave them behind
+    if args.summary and args.summary.endswith(".parquet") and importlib.util.find_spec("pyarrow") is None:
+        parser.error("writing a .parquet summary needs pyarrow. Use a .tsv instead, or install pyarrow.")
+    return args
+
+def normalize_product(product: str) -> str:
+    """
+    Tidies up a product name so that stray whitespace doesn't stop it from matching.
+
+    >>> normalize_product(" 12S  ribosomal RNA ")
+    '12S ribosomal RNA'
+    """
+    return " ".join(product.split())
+
+def get_product(attributes: str) -> Optional[str]:
+    """
+    Pulls the first product value out of a GFF attribute column without parsing the other tags.
+
+    Args:
+        attributes: the 9th column of a GFF line, e.g. "ID=X_00001;product=12S ribosomal RNA"
+    Returns:
+        the unescaped, normalized (see normalize_product) product string, or None if there isn't one
+
+    >>> get_product("ID=X_00001;locus_tag=X_00001;product=12S%20 ribosomal RNA")
+    '12S ribosomal RNA'
+    >>> get_product("ID=X_00002;note=no product=here") is None
+    True
+    """
+    idx = attributes.find("product=")
+    # make sure we're looking at the start of a tag, not the middle of some other value
+    while idx > 0 and attributes[idx - 1] != ";":
+        idx = attributes.find("product=", idx + 1)
+    if idx < 0:
+        return None
+
+    end = attributes.find(";", idx)
+    value = attributes[idx + len("product="):] if end < 0 else attributes[idx + len("product="):end]
+    # multiple values are comma separated, and we only ever look at the first one (same as BCBio)
+    return normalize_product(unquote(value.split(",", 1)[0]))
+
+def read_gff_features(lines: Iterable[str], products: Iterable[str]) -> Tuple[Dict[str, List[SeqFeature]], Dict[str, List[tuple]]]:
+    """
+    Reads the annotation section of a GFF file, up to and including the ##FASTA line.
+
+    Only features with a product in `products` are built, and the only qualifier they
+    carry is the product. Everything else in the annotation section is skipped, so the
+    features held in memory are tiny compared to the full annotation.
+
+    Args:
+        lines: the lines of the GFF file. If this is an iterator, it's left at the start of the sequences.
+        products: the product names that are worth keeping
+    Returns:
+        a tuple of dictionaries of sequence ID -> features, for (features, features split across the origin)
+    """
+    load_libraries()
+    products = set(products)
+    features: Dict[str, List[SeqFeature]] = {}
+    wrapped: Dict[str, List[tuple]] = {}
+
+    for line in lines:
+        if line.startswith("##FASTA"):
+            break
+        if line.startswith("#") or not line.strip():
+            continue
+
+        cols = line.rstrip("\n").split("\t")
+        if len(cols) < 9:
+            continue
+
+        product = get_product(cols[8])
+        if product is None or product not in products:
+            continue
+
+        start, end = int(cols[3]) - 1, int(cols[4]) # GFF indexes at 1, biopython indexes at 0
+        strand = {"+": 1, "-": -1}.get(cols[6])
+        if end <= start:
+            # split across the origin. We can't unwrap it until we know how long the sequence is.
+            wrapped.setdefault(cols[0], []).append((start, end, strand, cols[2], product))
+            continue
+
+        features.setdefault(cols[0], []).append(
+            SeqFeature(
+                FeatureLocation(start, end, strand=strand),
+                type=cols[2],
+                qualifiers={"product": [product]}
+            )
+        )
+
+    return features, wrapped
+
+def read_gff_records(gff_file: TextIO, products: Iterable[str]) -> Iterator[SeqRecord]:
+    """
+    Streams sequence records out of a GFF file with a ##FASTA section, one at a time.
+
+    Only the features in `products` are kept (see read_gff_features). Sequences are read
+    one at a time out of the ##FASTA section and each record is yielded as soon as its
+    sequence is complete. This works on any stream; for files on disk, read_gff_file
+    avoids reading the sequences at all.
+
+    Args:
+        gff_file: an open GFF file (Prokka-style, annotations followed by ##FASTA)
+        products: the product names that are worth keeping
+    Returns:
+        an iterator of BioPython sequence records, in the order of the ##FASTA section
+    """
+    load_libraries()
+    lines = iter(gff_file)
+    features, wrapped = read_gff_features(lines, products)
+
+    # now the sequences. Each record only exists long enough for the caller to deal with it.
+    seq_id: Optional[str] = None
+    chunks: List[str] = []
+    for line in lines:
+        if line.startswith(">"):
+            if seq_id is not None:
+                yield build_record(seq_id, Seq("".join(chunks)), features.pop(seq_id, []), wrapped.pop(seq_id, []))
+            seq_id = line[1:].split(None, 1)[0]
+            chunks = []
+        else:
+            chunks.append(line.strip())
+    if seq_id is not None:
+        yield build_record(seq_id, Seq("".join(chunks)), features.pop(seq_id, []), wrapped.pop(seq_id, []))
+
+def read_gff_file(path: str, products: Iterable[str], shard: Optional[list] = None) -> Iterator[SeqRecord]:
+    """
+    Reads sequence records out of a GFF file on disk, without reading their sequences.
+
+    The ##FASTA section is indexed through a memory map (see FastaIndex), and each
+    record's sequence only reads the bytes that are asked for. The map is kept open for
+    as long as any of the records are.
+
+    Args:
+        path: the location of a GFF file with a ##FASTA section
+        products: the product names that are worth keeping
+        shard: records from index_gff, to only read those records. Defaults to the whole file.
+    Returns:
+        an iterator of BioPython sequence records, in the order of the ##FASTA section
+    """
+    load_libraries()
+    with open(path, "rb") as gff_file:
+        if os.fstat(gff_file.fileno()).st_size == 0:
+            return
+
+        # not closed here: the records need it, and it closes itself when they're gone
+        buf = mmap.mmap(gff_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if shard is None:
+            features, wrapped = read_gff_features((line.decode() for line in gff_file), products)
+            fasta = FastaIndex(buf, gff_file.tell())
+        else:
+            lines = (line for _, spans, _ in shard for start, end in spans
+                     for line in buf[start:end].decode().splitlines(True))
+            features, wrapped = read_gff_features(lines, products)
+            fasta = FastaIndex(buf)
+            for _, _, (start, end) in shard:
+                fasta.add(start, end)
+
+    for seq_id in fasta.names:
+        seq = Seq(MappedSequenceData(fasta, seq_id))
+        yield build_record(seq_id, seq, features.pop(seq_id, []), wrapped.pop(seq_id, []))
+
+def fasta_ranges(buf: mmap.mmap, start: int = 0) -> Iterator[Tuple[int, int]]:
+    """
+    Finds the byte range of every record in a (memory mapped) FASTA file.
+
+    Args:
+        buf: the file contents
+        start: where the FASTA part of the file starts
+    Returns:
+        an iterator of (header start, record end) byte offsets
+    """
+    header = buf.find(b">", start)
+    while header >= 0:
+        next_header = buf.find(b"\n>", header)
+        yield header, len(buf) if next_header < 0 else next_header + 1
+        header = -1 if next_header < 0 else next_header + 1
+
+class FastaIndex:
+    """
+    A faidx-style index of the sequences in a memory mapped FASTA (or ##FASTA section).
+
+    Each sequence is stored as (length, byte offset, bases per line, bytes per line), so
+    any slice of it can be read straight out of the file.
+    """
+
+    def __init__(self, buf: mmap.mmap, start: Optional[int] = None):
+        """
+        Args:
+            buf: the file contents
+            start: where the FASTA part of the file starts. Leave it out to add records with add().
+        """
+        self.buf = buf
+        self.entries: Dict[str, Tuple[int, int, int, int]] = {}
+        self.names: List[str] = []
+        if start is not None:
+            for header, end in fasta_ranges(buf, start):
+                self.add(header, end)
+
+    def add(self, header: int, end: int) -> str:
+        """
+        Indexes the record between two byte offsets.
+
+        Args:
+            header: the offset of the record's '>'
+            end: the offset of the end of the record
+        Returns:
+            the sequence ID
+        """
+        buf = self.buf
+        seq_start = buf.find(b"\n", header, end)
+        seq_start = end if seq_start < 0 else seq_start + 1
+        seq_id = buf[header + 1:seq_start].split(None, 1)[0].decode()
+
+        seq_end = end
+        while seq_end > seq_start and buf[seq_end - 1] in b"\r\n \t":
+            seq_end -= 1
+
+        first_nl = buf.find(b"\n", seq_start, seq_end)
+        if first_nl < 0:
+            # one line (or no sequence at all)
+            line_bases = line_bytes = max(seq_end - seq_start, 1)
+            length = seq_end - seq_start
+        else:
+            line_bytes = first_nl - seq_start + 1
+            line_bases = line_bytes - (2 if buf[first_nl - 1] == ord("\r") else 1)
+            # pretend the last line has a line ending too, then it's all whole lines except maybe the last one
+            padded = seq_end - seq_start + line_bytes - line_bases
+            length = padded // line_bytes * line_bases + max(padded % line_bytes - (line_bytes - line_bases), 0)
+
+            # every line but the last has to be the same width, or else none of that works
+            line_ends = buf[seq_start + line_bytes - 1:seq_end:line_bytes]
+            if line_ends.count(b"\n") != len(line_ends) or line_bases <= 0:
+                raise ValueError(f"Sequence '{seq_id}' has lines of different lengths, so it can't be indexed.")
+
+        if seq_id not in self.entries:
+            self.names.append(seq_id)
+        self.entries[seq_id] = (length, seq_start, line_bases, line_bytes)
+        return seq_id
+
+    def length(self, seq_id: str) -> int:
+        """The length of a sequence."""
+        return self.entries[seq_id][0]
+
+    def fetch(self, seq_id: str, start: int, end: int) -> bytes:
+        """
+        Reads part of a sequence straight out of the file.
+
+        Args:
+            seq_id: the sequence ID
+            start: the first position (0 indexed)
+            end: one past the last position
+        Returns:
+            the sequence data between start and end
+        """
+        length, offset, line_bases, line_bytes = self.entries[seq_id]
+        start, end = max(start, 0), min(end, length)
+        if start >= end:
+            return b""
+
+        raw = self.buf[offset + start // line_bases * line_bytes + start % line_bases:
+                       offset + end // line_bases * line_bytes + end % line_bases]
+        return raw if line_bases == line_bytes else raw.translate(None, b"\r\n")
+
+class MappedSequence:
+    """
+    Sequence data for a BioPython Seq that's only read out of a FastaIndex when it's needed.
+
+    Seq needs its data to be a SequenceDataAbstractBaseClass, so this is only used through
+    MappedSequenceData, which load_libraries makes out of the two.
+    """
+
+    __slots__ = ("_fasta", "_seq_id")
+
+    def __init__(self, fasta: FastaIndex, seq_id: str):
+        self._fasta = fasta
+        self._seq_id = seq_id
+        super().__init__()
+
+    def __len__(self):
+        return self._fasta.length(self._seq_id)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(len(self))
+            if step != 1:
+                return self._fasta.fetch(self._seq_id, 0, len(self))[key]
+            return self._fasta.fetch(self._seq_id, start, end)
+        # a single position is an int, like indexing bytes
+        if key < 0:
+            key += len(self)
+        return self._fasta.fetch(self._seq_id, key, key + 1)[0]
+
+def build_record(seq_id: str, seq: Seq, features: List[SeqFeature], wrapped: List[tuple]) -> SeqRecord:
+    """
+    Puts a record back together once its sequence has been read.
+
+    Features that are split across the origin are unwrapped: they start near the end of
+    the sequence and end past it, e.g. 9990..10010 in a 10000 nt sequence.
+
+    Args:
+        seq_id: the sequence ID
+        seq: the sequence data
+        features: the features that don't span the origin
+        wrapped: (start, end, strand, type, product) tuples of features that do
+    Returns:
+        a BioPython sequence record
+    """
+    load_libraries()
+    for start, end, strand, feat_type, product in wrapped:
+        features.append(
+            SeqFeature(
+                FeatureLocation(start, end + len(seq), strand=strand),
+                type=feat_type,
+                qualifiers={"product": [product]}
+            )
+        )
+    return SeqRecord(seq, id=seq_id, features=features)
 
 def check_flip(start_annot, end_annot) -> bool:
     """
@@ -114,9 +627,24 @@ def parse_seq(rec, start_annot, end_annot, bound_end_strand) -> str:
         The sequence data between the two annotations as a string.
     """
 
-    # return an empty sequence if one of the bounds is missing.
+    bounds = region_bounds(len(rec), start_annot, end_annot, bound_end_strand)
+    # an empty sequence if one of the bounds is missing
+    return extract_batch([None if bounds is None else (rec,) + bounds])[0]
+
+def region_bounds(seq_len: int, start_annot, end_annot, bound_end_strand) -> Optional[Tuple[int, int, bool, bool]]:
+    """
+    Works out where a region is, and which of the four orientations it's in (see parse_seq).
+
+    Args:
+        seq_len: the length of the sequence
+        start_annot: A BioPython sequence feature
+        end_annot: Another sequence feature
+        bound_end_strand: the strand the end annotation is expected on
+    Returns:
+        a tuple of (near bound, far bound, inner, rev_comp), or None if one of the bounds is missing
+    """
     if end_annot is None or start_annot is None:
-        return ""
+        return None
 
     rev_comp = False
     inner = False
@@ -155,7 +683,7 @@ def parse_seq(rec, start_annot, end_annot, bound_end_strand) -> str:
     # The "near" bound is closer to the 5' end
     near_bound = 0
     # It's the "far" bound because it's further from the 5' end.
-    far_bound = len(rec)
+    far_bound = seq_len
 
     # Set the variables to their correct value, assuming the boundaries were found, otherwise
     # they just stay as the defaults.
@@ -166,22 +694,74 @@ def parse_seq(rec, start_annot, end_annot, bound_end_strand) -> str:
         if start_annot is not None: near_bound = start_annot.location.start
         if end_annot is not None: far_bound = end_annot.location.end
 
+    return int(near_bound), int(far_bound), inner, rev_comp
+
+def region_segments(seq_len: int, near_bound: int, far_bound: int, inner: bool) -> List[Tuple[int, int]]:
+    """
+    The slices of the sequence that make up a region, in order.
+
+    Args:
+        seq_len: the length of the sequence
+        near_bound: the bound closer to the 5' end
+        far_bound: the bound further from the 5' end
+        inner: take from between the bounds instead of the tails
+    Returns:
+        a list of (start, end) slices. The region is all of them concatenated.
+
+    >>> region_segments(100, 10, 80, False)
+    [(80, 100), (0, 10)]
+    >>> region_segments(100, 10, 105, False)
+    [(5, 10)]
+    >>> region_segments(100, 80, 10, True)
+    [(10, 80)]
+    """
     ## DEFAULT BEHAVIOUR:
     # take from the 12S rRNA to the end, then from the beginning to the
     if not inner:
-        out_seq = rec.seq[far_bound:]+rec.seq[:near_bound]
+        if far_bound >= seq_len:
+            # the far annotation spans the origin, so the region starts after the origin
+            return [(far_bound - seq_len, near_bound)]
+        return [(far_bound, seq_len), (0, near_bound)]
 
     ## MODIFIED BEHAVIOUR:
     #  Take BETWEEN the rRNA and the tRNA.
     # This is "backwards" because the expected far bound is nearer when this happens.
-    else:
-        out_seq = rec.seq[far_bound:near_bound]
+    return [(far_bound, near_bound)]
 
-    # if it's supposed to get reversed, reverse it.
-    if rev_comp:
-        out_seq = out_seq.reverse_complement()
+# IUPAC nucleotide codes and their complements, for bytes.translate
+COMPLEMENT = bytes.maketrans(b"ACGTUMRWSYKVHDBNacgtumrwsykvhdbn", b"TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn")
 
-    return str(out_seq)
+def reverse_complement(seq: bytes) -> bytes:
+    """
+    Reverse complements DNA sequence data.
+
+    >>> reverse_complement(b"AACGTn")
+    b'nACGTT'
+    """
+    return seq.translate(COMPLEMENT)[::-1]
+
+def extract_batch(regions: Sequence[Optional[Tuple[SeqRecord, int, int, bool, bool]]]) -> List[str]:
+    """
+    Cuts out many regions at once, reverse complementing the ones that need it.
+
+    Args:
+        regions: (record, near bound, far bound, inner, rev_comp) tuples, where the bounds and
+                 flags come from region_bounds. None for regions that weren't found.
+    Returns:
+        the sequence data of each region, as strings
+    """
+    load_libraries()
+    out_seqs = []
+    for region in regions:
+        if region is None:
+            out_seqs.append("")
+            continue
+        rec, near_bound, far_bound, inner, rev_comp = region
+        out_seq = b"".join(bytes(rec.seq[start:end])
+                           for start, end in region_segments(len(rec), near_bound, far_bound, inner)
+                           if end > start)
+        out_seqs.append((reverse_complement(out_seq) if rev_comp else out_seq).decode())
+    return out_seqs
 
 def circular_distance(a: int, b: int, C: int) -> int:
     """
@@ -229,107 +809,705 @@ def check_anchor(anchor_loc: int, seq_len: int, loc1: int, loc2: int) -> bool:
     return (circular_distance(loc1, anchor_loc, seq_len)
             > circular_distance(loc2, anchor_loc, seq_len))
 
-def find_bound(seq_len: int, all_annots, anchor: int):
+def find_bound(index: "CircularIndex", products: Iterable[str], anchor: Optional[int]):
     """
-    Finds the first annotation that matches the highest priority boundary.
+    Finds the annotation that matches a boundary and is closest to the anchor.
 
     Args:
-        seq_leb: a sequence length
-        all_annots: a list of BioPython sequence features
+        index: the record's circular feature index
+        products: the boundary's product names
         anchor: the anchor location
     Return:
         a BioPython sequence feature or None.
     """
-    best_fit = None
-    for annot in all_annots:
-        # if there is a best fit and it is closer than the new one, skip this annotation.
-        # if there isn't a best fit, or the new annotation is closer to the anchor, reassign best_fit
-        if (best_fit is None
-                or not check_anchor(anchor, seq_len, int(annot.location.start), int(best_fit.location.start))):
-            best_fit = annot
-        if anchor is None:
-            return best_fit
-    # if there's an anchor, we have to get to the very end to find the best match. Otherwise, it breaks early, as above.
+    # IF NO ANCHOR IS GIVEN OR FOUND, it just uses the first occurence
+    if anchor is None:
+        annots = index.features(products)
+        return annots[0] if annots else None
     # if there are no matches, it just returns None.
-    return best_fit
+    return index.nearest(products, anchor)
 
-def find_anchor(bound_start_anchor: List[Tuple[str, str]], start_anchor_annots):
+def find_anchor(bound_start_anchor: List[Tuple[str, str]], index: "CircularIndex"):
     """
     Finds the first available anchor gene and returns its position
 
+    The anchors are tried in priority order, so a record without the first one (e.g. a
+    partial genome with no ND2) is anchored on the next one it has.
+
     Args:
         bound_start_anchor: a tuple containing tuples of: (feature name, "start"/"end")
-        start_anchor_annots: a list containing all the possible start anchors (even ones that are low-priority)
+        index: the record's circular feature index
     Return:
-        the start position of the anchor or -1 if there's no anchor
+        the start position of the anchor or None if there's no anchor
     """
     for s_anch in bound_start_anchor:
-        for annot in start_anchor_annots:
-            if annot.qualifiers["product"][0] == s_anch[0]:
-                anch_pos = None
-                if ((s_anch[1] == "start" and annot.location.strand == 1)
-                        or (s_anch[1] == "end" and annot.location.strand == -1)):
-                    anch_pos = annot.location.start
-                elif ((s_anch[1] == "start" and annot.location.strand == -1)
-                        or (s_anch[1] == "end" and annot.location.strand == 1)):
-                    anch_pos = annot.location.end
+        anchor_annots = index.products.get(normalize_product(s_anch[0]))
+        if anchor_annots:
+            annot = anchor_annots[0]
+            anch_pos = None
+            if ((s_anch[1] == "start" and annot.location.strand == 1)
+                    or (s_anch[1] == "end" and annot.location.strand == -1)):
+                anch_pos = annot.location.start
+            elif ((s_anch[1] == "start" and annot.location.strand == -1)
+                    or (s_anch[1] == "end" and annot.location.strand == 1)):
+                anch_pos = annot.location.end
 
-                return anch_pos # Bonus: this breaks both loops
-    return None # otherwise, return the default (which is -1)
+            return anch_pos
+    return None # otherwise, return the default
 
-#  Dict[str, SeqFeature] ->  -> list[SeqFeature]
-def get_features(product_features, products: Iterable[str]):
+def index_products(features: Iterable[SeqFeature]) -> Dict[str, List[SeqFeature]]:
     """
-    Returns a list of annotations with products matching those in a tuple.
+    Builds the per-record lookup table of features by product, so that every boundary
+    and anchor lookup afterwards is a dictionary hit instead of a scan over the features.
 
     Args:
-        product_features: a list of sequence features with products
-        products: a tuple of acceptable product strings
+        features: a record's sequence features
     Return:
-        a list of features with the specified products
+        a dictionary of normalized product name -> features with that product, sorted by position
+    """
+    product_index: Dict[str, List[SeqFeature]] = {}
+    for feat in features:
+        if 'product' in feat.qualifiers:
+            product_index.setdefault(normalize_product(feat.qualifiers['product'][0]), []).append(feat)
+
+    for feats in product_index.values():
+        feats.sort(key=lambda f: int(f.location.start)) # stable, so ties stay in file order
+    return product_index
+
+class CircularIndex:
+    """
+    A record's features, indexed by product, on a circular sequence of known length.
+
+    Features are in unwrapped coordinates (see build_record), so every start is inside
+    the sequence, and features that span the origin end past seq_len.
+    """
+
+    def __init__(self, seq_len: int, features: Iterable[SeqFeature]):
+        features = list(features)
+        self.seq_len = seq_len
+        self.products = index_products(features)
+        # where each feature was in the file, to break ties between products the same way a scan would
+        self._order = {id(f): i for i, f in enumerate(features)}
+        # (starts, features) sorted by start, for each combination of products that's been asked for
+        self._merged: Dict[Tuple[str, ...], Tuple[List[int], List[SeqFeature]]] = {}
+
+    def _lookup(self, products: Iterable[str]) -> Tuple[List[int], List[SeqFeature]]:
+        # dict.fromkeys drops duplicates but keeps the order
+        key = tuple(dict.fromkeys(map(normalize_product, products)))
+        if key not in self._merged:
+            found = [self.products[p] for p in key if p in self.products]
+            if len(found) == 1:
+                feats = found[0]
+            else:
+                feats = sorted((f for prod_feats in found for f in prod_feats),
+                               key=lambda f: (int(f.location.start), self._order[id(f)]))
+            self._merged[key] = ([int(f.location.start) for f in feats], feats)
+        return self._merged[key]
+
+    def features(self, products: Iterable[str]) -> List[SeqFeature]:
+        """
+        Returns all the features with any of the products, sorted by position.
+
+        Args:
+            products: the acceptable product strings
+        Return:
+            a list of features
+        """
+        return list(self._lookup(products)[1])
+
+    def nearest(self, products: Iterable[str], pos: int) -> Optional[SeqFeature]:
+        """
+        Finds the feature with any of the products whose start is closest to a position,
+        going either way around the circle. Ties go to the feature further along the sequence.
+
+        Args:
+            products: the acceptable product strings
+            pos: a position on the sequence
+        Return:
+            a BioPython sequence feature or None
+        """
+        starts, feats = self._lookup(products)
+        if not feats:
+            return None
+
+        # the closest feature is the last one before the position, or the first one at or after it
+        i = bisect.bisect_left(starts, pos % self.seq_len)
+        before = (i - 1) % len(starts)
+        after = bisect.bisect_right(starts, starts[i % len(starts)]) - 1 # the last of any features starting at the same place
+
+        if check_anchor(pos, self.seq_len, starts[before], starts[after]):
+            return feats[after]
+        if check_anchor(pos, self.seq_len, starts[after], starts[before]):
+            return feats[before]
+        return feats[max(before, after)]
+
+class RegionMatch(NamedTuple):
+    """Everything that was found on the way to one region in one record."""
+    anchor: Optional[int]
+    start_annot: Optional[SeqFeature]
+    end_annot: Optional[SeqFeature]
+    # from region_bounds
+    bounds: Optional[Tuple[int, int, bool, bool]]
+
+def match_region(rec: SeqRecord, index: CircularIndex, profile: BoundaryProfile) -> RegionMatch:
+    """
+    Finds one region in a record, keeping the anchor and boundary features that were chosen.
+
+    Args:
+        rec: a BioPython sequence record
+        index: the record's circular feature index
+        profile: the boundaries of the region
+    Returns:
+        the anchor position, the boundary features, and the bounds (None where they weren't found)
+    """
+    with METRICS.stage("find_anchor"):
+        s_anchor_loc = find_anchor(profile.bound_start_anchor, index)
+
+    # through every possible start/end bound
+    with METRICS.stage("find_bound"):
+        start_annot = find_bound(index, profile.bound_start, s_anchor_loc)
+        end_annot = find_bound(index, profile.bound_end, None)
+
+    return RegionMatch(s_anchor_loc, start_annot, end_annot,
+                       region_bounds(len(rec), start_annot, end_annot, profile.bound_end_strand))
+
+def region_length(seq_len: int, bounds: Optional[Tuple[int, int, bool, bool]]) -> int:
+    """
+    How long a region is, from its bounds (0 if it wasn't found).
+
+    >>> region_length(100, (10, 80, False, False))
+    30
+    >>> region_length(100, (80, 10, True, False))
+    70
+    """
+    if bounds is None:
+        return 0
+    return sum(max(end - start, 0) for start, end in region_segments(seq_len, *bounds[:3]))
+
+# the columns of the summary (see summary_row), and their types
+SUMMARY_COLUMNS = [
+    ("record", "string"), ("region", "string"), ("seq_len", "int"),
+    # "ok", or which boundaries are missing: "missing_start", "missing_end" or "missing_both"
+    ("status", "string"), ("orientation", "string"), ("inner", "bool"), ("rev_comp", "bool"),
+    ("anchor", "int"),
+    ("start_product", "string"), ("start_feature_start", "int"), ("start_feature_end", "int"), ("start_strand", "int"),
+    ("end_product", "string"), ("end_feature_start", "int"), ("end_feature_end", "int"), ("end_strand", "int"),
+    ("near_bound", "int"), ("far_bound", "int"), ("region_len", "int"),
+]
+
+def summary_row(rec_id: str, seq_len: int, profile: BoundaryProfile, match: RegionMatch) -> Dict[str, object]:
+    """
+    Describes how one region was found, as a row of the summary.
+
+    Positions are 0 indexed and end exclusive, like Biopython's. Features across the origin
+    end past the end of the sequence (see build_record). Anything that wasn't found is None.
+
+    Args:
+        rec_id: the record ID
+        seq_len: the length of the record's sequence
+        profile: the boundaries of the region
+        match: what match_region found
+    Returns:
+        a dictionary with every column in SUMMARY_COLUMNS
+    """
+    missing = [side for side, annot in (("start", match.start_annot), ("end", match.end_annot)) if annot is None]
+    row: Dict[str, object] = {
+        "record": rec_id,
+        "region": profile.name,
+        "seq_len": seq_len,
+        "status": "ok" if not missing else "missing_" + ("both" if len(missing) == 2 else missing[0]),
+        "orientation": orientation(match.bounds),
+        "inner": None if match.bounds is None else match.bounds[2],
+        "rev_comp": None if match.bounds is None else match.bounds[3],
+        "anchor": None if match.anchor is None else int(match.anchor),
+        "near_bound": None if match.bounds is None else match.bounds[0],
+        "far_bound": None if match.bounds is None else match.bounds[1],
+        "region_len": region_length(seq_len, match.bounds),
+    }
+    for side, annot in (("start", match.start_annot), ("end", match.end_annot)):
+        row[f"{side}_product"] = None if annot is None else annot.qualifiers["product"][0]
+        row[f"{side}_feature_start"] = None if annot is None else int(annot.location.start)
+        row[f"{side}_feature_end"] = None if annot is None else int(annot.location.end)
+        row[f"{side}_strand"] = None if annot is None else annot.location.strand
+    return row
+
+def orientation(bounds: Optional[Tuple[int, int, bool, bool]]) -> str:
+    """
+    Names the orientation a region was found in (see parse_seq).
+
+    >>> orientation((10, 80, True, True))
+    'rotated_rev_comp'
+    """
+    if bounds is None:
+        return "missing"
+    _, _, inner, rev_comp = bounds
+    # taking the inner part of the sequence is what makes it rotated
+    return {(False, False): "normal", (False, True): "rev_comp",
+            (True, False): "rotated", (True, True): "rotated_rev_comp"}[(inner, rev_comp)]
+
+def iter_regions(records: Iterable[SeqRecord], profiles: List[BoundaryProfile], batch_size: int = BATCH_SIZE,
+                 summary: bool = True) -> Iterator[List[Tuple[str, Optional[Dict[str, object]]]]]:
+    """
+    Finds every region in every record, cutting them out batch_size records at a time with extract_batch.
+
+    Args:
+        records: BioPython sequence records
+        profiles: the boundaries of each region
+        batch_size: the number of records per batch
+        summary: work out the summary rows. Otherwise, every row is None.
+    Returns:
+        an iterator of lists of (FASTA formatted string, summary row), one list per record and one pair per profile
+    """
+    batch: List[List[Optional[tuple]]] = [[] for _ in profiles]
+    rec_ids: List[str] = []
+    rec_rows: List[List[Optional[Dict[str, object]]]] = []
+
+    def flush() -> List[List[Tuple[str, Optional[Dict[str, object]]]]]:
+        rec_entries: List[List[Tuple[str, Optional[Dict[str, object]]]]] = [[] for _ in rec_ids]
+        for i, (prof, prof_batch) in enumerate(zip(profiles, batch)):
+            with METRICS.stage("parse_seq"):
+                prof_seqs = extract_batch(prof_batch)
+            for entries, rec_id, rows, out_seq in zip(rec_entries, rec_ids, rec_rows, prof_seqs):
+                entries.append((f">{rec_id}_{prof.name}\n{out_seq}\n", rows[i]))
+            prof_batch.clear()
+        rec_ids.clear()
+        rec_rows.clear()
+        return rec_entries
+
+    for rec in records:
+        # built once per record, and shared by every profile
+        with METRICS.stage("index"):
+            index = CircularIndex(len(rec), rec.features)
+        rec_ids.append(rec.id)
+        rows = []
+        for prof, prof_batch in zip(profiles, batch):
+            match = match_region(rec, index, prof)
+            bounds = match.bounds
+            prof_batch.append(None if bounds is None else (rec,) + bounds)
+            rows.append(summary_row(rec.id, len(rec), prof, match) if summary else None)
+            if METRICS.enabled:
+                METRICS.record(record=rec.id, region=prof.name, seq_len=len(rec),
+                               candidates=len(index.features(prof.bound_start)) + len(index.features(prof.bound_end)),
+                               orientation=orientation(bounds),
+                               region_len=region_length(len(rec), bounds))
+        rec_rows.append(rows)
+        if len(rec_ids) >= batch_size:
+            yield from flush()
+    yield from flush()
+
+def batch_regions(regions: Iterable[List[Tuple[str, Optional[Dict[str, object]]]]], n_profiles: int,
+                  batch_size: int = BATCH_SIZE) -> Iterator[Tuple[List[str], List[Dict[str, object]]]]:
+    """
+    Joins the FASTA entries from iter_regions into one block of text per profile, batch_size
+    records at a time, and gathers up each batch's summary rows.
+
+    Returns:
+        an iterator of (a list of strings, one per profile; the summary rows, in record then
+        profile order), one per batch
     """
-    return [f for f in product_features if f.qualifiers['product'][0] in products]
+    out_seqs: List[List[str]] = [[] for _ in range(n_profiles)]
+    rows: List[Dict[str, object]] = []
+    n_records = 0
+    for entries in regions:
+        for prof_out, (entry, row) in zip(out_seqs, entries):
+            prof_out.append(entry)
+            if row is not None:
+                rows.append(row)
+        n_records += 1
+        if n_records == batch_size:
+            yield ["".join(prof_out) for prof_out in out_seqs], rows
+            out_seqs, rows, n_records = [[] for _ in range(n_profiles)], [], 0
 
-def main():
+    if n_records:
+        yield ["".join(prof_out) for prof_out in out_seqs], rows
+
+def join_regions(records: Iterable[SeqRecord], profiles: List[BoundaryProfile], batch_size: int = BATCH_SIZE) -> List[str]:
+    """
+    Finds every region in every record (see iter_regions), and joins the FASTA entries into one block of text per profile.
+
+    Args:
+        records: BioPython sequence records
+        profiles: the boundaries of each region
+        batch_size: the number of records per batch
+    Returns:
+        a list of strings, one per profile
+    """
+    blocks: List[List[str]] = [[] for _ in profiles]
+    for out_seqs, _ in batch_regions(iter_regions(records, profiles, batch_size, summary=False), len(profiles), batch_size):
+        for block, out_seq in zip(blocks, out_seqs):
+            block.append(out_seq)
+    return ["".join(block) for block in blocks]
+
+class SummaryWriter:
+    """
+    Writes summary rows (see summary_row), a batch at a time, as TSV or as Parquet.
+
+    A path ending in .parquet is written with pyarrow (which has to be installed), one
+    row group per batch; anything else is tab separated, with a header, empty cells for
+    missing values, and "true"/"false" for flags.
+    """
+
+    def __init__(self, path: str, force: bool = False):
+        self._stack = contextlib.ExitStack()
+        self._parquet = None
+        if path.endswith(".parquet"):
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Writing a .parquet summary needs pyarrow. Use a .tsv instead, or install pyarrow.") from None
+            arrow_types = {"string": pa.string(), "int": pa.int64(), "bool": pa.bool_()}
+            self._schema = pa.schema([(name, arrow_types[kind]) for name, kind in SUMMARY_COLUMNS])
+            self._table = pa.Table.from_pydict
+            out_file = self._stack.enter_context(open(path, "wb" if force else "xb"))
+            self._parquet = self._stack.enter_context(pq.ParquetWriter(out_file, self._schema))
+        else:
+            self._tsv = self._stack.enter_context(streams.open_output(path, force))
+            self._tsv.write("\t".join(name for name, _ in SUMMARY_COLUMNS) + "\n")
+
+    def write(self, rows: List[Dict[str, object]]):
+        """Writes a batch of rows."""
+        if not rows:
+            return
+        if self._parquet is not None:
+            self._parquet.write_table(self._table({name: [row[name] for row in rows] for name, _ in SUMMARY_COLUMNS},
+                                                  schema=self._schema))
+            return
+
+        lines = []
+        for row in rows:
+            cells = (row[name] for name, _ in SUMMARY_COLUMNS)
+            lines.append("\t".join("" if cell is None else ("true" if cell else "false") if isinstance(cell, bool)
+                                   else str(cell) for cell in cells) + "\n")
+        self._tsv.write("".join(lines))
+
+    def close(self):
+        self._stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class UniqueWriter:
+    """
+    Writes one representative of each distinct sequence (the first record it was found in),
+    and a table of which representative every record's region went to, so that the
+    same sequence is only ever searched once downstream.
+
+    Sequences are only kept as a hash, so memory grows with the number of distinct
+    sequences, not their length.
+    """
+
+    def __init__(self, fasta_path: str, members_path: str, force: bool = False):
+        self._stack = contextlib.ExitStack()
+        self._fasta = self._stack.enter_context(streams.open_output(fasta_path, force))
+        self._members = self._stack.enter_context(streams.open_output(members_path, force))
+        self._members.write("representative\tmember\n")
+        # sequence hash -> representative name
+        self._seen: Dict[bytes, str] = {}
+
+    def write(self, entries: str):
+        """Writes the representatives and members for a block of FASTA entries (as from batch_regions)."""
+        lines = entries.split("\n")
+        reps, members = [], []
+        # every entry is exactly two lines, ">name" and the sequence
+        for header, seq in zip(lines[0::2], lines[1::2]):
+            name = header[1:]
+            digest = hashlib.blake2b(seq.encode(), digest_size=16).digest()
+            rep = self._seen.setdefault(digest, name)
+            if rep == name:
+                reps.append(f"{header}\n{seq}\n")
+            members.append(f"{rep}\t{name}\n")
+        self._fasta.write("".join(reps))
+        self._members.write("".join(members))
+
+    def close(self):
+        self._stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def index_gff(path: str) -> List[Tuple[str, List[Tuple[int, int]], Tuple[int, int]]]:
+    """
+    Does a quick pass over a multi-record GFF file and notes where each record lives.
+
+    Nothing is parsed here beyond the sequence ID of each feature line and the FASTA
+    headers. The ##FASTA section is searched through a memory map, so this is mostly
+    just as fast as the disk.
+
+    Args:
+        path: the location of a GFF file with a ##FASTA section
+    Returns:
+        a list of (sequence ID, feature byte ranges, sequence byte range), in FASTA order
+    """
+    feature_spans: Dict[str, List[Tuple[int, int]]] = {}
+
+    with open(path, "rb") as gff_file:
+        offset = 0
+        for line in gff_file:
+            next_offset = offset + len(line)
+            if line.startswith(b"##FASTA"):
+                break
+            if not line.startswith(b"#") and line.strip():
+                seq_id = line.split(b"\t", 1)[0].decode()
+                spans = feature_spans.setdefault(seq_id, [])
+                # Prokka keeps the features of each record together, so they usually collapse into one range
+                if spans and spans[-1][1] == offset:
+                    spans[-1] = (spans[-1][0], next_offset)
+                else:
+                    spans.append((offset, next_offset))
+            offset = next_offset
+        else:
+            return [] # no ##FASTA section, so there's nothing to extract
+
+        fasta_start = next_offset
+        if os.fstat(gff_file.fileno()).st_size <= fasta_start:
+            return []
+
+        records: List[Tuple[str, List[Tuple[int, int]], Tuple[int, int]]] = []
+        with mmap.mmap(gff_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for header, end in fasta_ranges(buf, fasta_start):
+                seq_id = buf[header + 1:buf.find(b"\n", header)].split(None, 1)[0].decode()
+                records.append((seq_id, feature_spans.get(seq_id, []), (header, end)))
+
+    return records
+
+def record_cache_keys(buf: mmap.mmap, record: Tuple[str, List[Tuple[int, int]], Tuple[int, int]],
+                      profiles: List[BoundaryProfile]) -> List[str]:
+    """
+    Works out the cache key of each region in a record, straight from the bytes of the file.
+
+    A key covers everything the region depends on: the record's features with a product
+    the profile looks at, the record's sequence (with its header), and the profile itself.
+    Nothing else in the record can change the region, so nothing else is hashed.
+
+    Args:
+        buf: the (memory mapped) GFF file
+        record: one record from index_gff
+        profiles: the boundaries of each region
+    Returns:
+        a list of cache keys, one per profile
+    """
+    _, spans, (header, end) = record
+
+    lines: List[Tuple[str, bytes]] = []
+    for start, stop in spans:
+        for line in buf[start:stop].splitlines():
+            cols = line.split(b"\t", 8)
+            if len(cols) < 9:
+                continue
+            product = get_product(cols[8].decode())
+            if product is not None:
+                lines.append((product, line))
+
+    seq = buf[header:end]
+    keys = []
+    for prof in profiles:
+        products = set(wanted_products([prof]))
+        features = b"\n".join(line for product, line in lines if product in products)
+        keys.append(region_cache.key(CACHE_VERSION, json.dumps(prof).encode(), features, seq))
+    return keys
+
+def cached_job(path: str, shard: Optional[list], profiles: List[BoundaryProfile],
+               cache: region_cache.RegionCache, summary: bool = True) -> Iterator[List[Tuple[str, Optional[Dict[str, object]]]]]:
+    """
+    Does the same as iter_regions, but through the cache.
+
+    The records are taken BATCH_SIZE at a time. Every record in a batch is hashed first
+    (see record_cache_keys). Records with every region cached are never parsed; the rest
+    are read and extracted as usual, and their regions are added to the cache.
+
+    Args:
+        path: the location of a GFF file with a ##FASTA section
+        shard: records from index_gff, or None for the whole file
+        profiles: the boundaries of each region
+        cache: where the regions are cached
+        summary: give back the summary rows. Otherwise, every row is None (they're cached either way).
+    Returns:
+        an iterator of lists of (FASTA formatted string, summary row), one list per record in
+        input order and one pair per profile
+    """
+    records = shard if shard is not None else index_gff(path)
+    if not records:
+        return
+    products = wanted_products(profiles)
+
+    with open(path, "rb") as gff_file, mmap.mmap(gff_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for i in range(0, len(records), BATCH_SIZE):
+            batch = records[i:i + BATCH_SIZE]
+            with METRICS.stage("cache_lookup"):
+                keys = [record_cache_keys(buf, rec, profiles) for rec in batch]
+                found: List[Optional[List[Tuple[str, Dict[str, object]]]]] = []
+                for rec_keys in keys:
+                    values = [cache.get(entry_key) for entry_key in rec_keys]
+                    # a record is only skipped if all of its regions are cached
+                    found.append(None if None in values else [tuple(json.loads(value)) for value in values])
+
+            misses = [rec for rec, entries in zip(batch, found) if entries is None]
+            fresh = iter_regions(METRICS.timed("gff_parse", read_gff_file(path, products, misses)), profiles)
+            for rec_keys, entries in zip(keys, found):
+                if entries is None:
+                    # read_gff_file gives the records back in the order they were asked for
+                    entries = next(fresh)
+                    with METRICS.stage("cache_store"):
+                        for entry_key, (entry, row) in zip(rec_keys, entries):
+                            cache.put(entry_key, json.dumps([entry, row]))
+                yield entries if summary else [(entry, None) for entry, _ in entries]
+
+def extract_job(job: Job) -> Iterator[Tuple[List[str], List[Dict[str, object]]]]:
+    """
+    Extracts the control regions for one unit of work: either a whole file, or a shard of one.
+
+    The regions come out BATCH_SIZE records at a time, so only a batch is ever held at once,
+    however big the input is.
+
+    Args:
+        job: the file (or shard of one), profiles, and cache to work with
+    Returns:
+        an iterator of batches (see batch_regions): the FASTA formatted regions, one string per
+        profile, and the summary rows (empty unless the job asks for them)
+    """
+    path, shard, profiles, cache, summary = job
+    products = wanted_products(profiles)
+
+    # can't be memory mapped, so it's read straight through
+    if streams.is_stream(path):
+        with streams.open_input(path) as gff_file:
+            yield from batch_regions(iter_regions(METRICS.timed("gff_parse", read_gff_records(gff_file, products)),
+                                                  profiles, summary=summary), len(profiles))
+        return
+
+    if cache is not None:
+        yield from batch_regions(cached_job(path, shard, profiles, cache, summary), len(profiles))
+        return
+
+    yield from batch_regions(iter_regions(METRICS.timed("gff_parse", read_gff_file(path, products, shard)),
+                                          profiles, summary=summary), len(profiles))
+
+def run_job(job: Job) -> Tuple[List[Tuple[List[str], List[Dict[str, object]]]], dict]:
+    """
+    Runs extract_job in a worker process, and sends back its batches along with the metrics
+    collected along the way. Jobs for the pool are a batch at most (see make_jobs).
+
+    Returns:
+        (the batches from extract_job, Metrics.drain())
+    """
+    return list(extract_job(job)), METRICS.drain()
+
+def pooled_batches(pool: "multiprocessing.pool.Pool", jobs: List[Job]) -> Iterator[Tuple[List[str], List[Dict[str, object]]]]:
+    """
+    Runs jobs on a worker pool, and gives back their batches in job order.
+
+    Shards go to the pool. Jobs without a shard (standard input and compressed files, which
+    can't be split up) are streamed through this process a batch at a time instead, while the
+    pool carries on with the shards after them.
+    """
+    # imap keeps the results in the same order as the jobs
+    results = pool.imap(run_job, [job for job in jobs if job.shard is not None])
+    for job in jobs:
+        if job.shard is None:
+            yield from extract_job(job)
+            continue
+        job_batches, job_metrics = next(results)
+        METRICS.merge(job_metrics)
+        yield from job_batches
+
+def make_jobs(paths: List[str], cpus: int, profiles: List[BoundaryProfile],
+              cache: Optional[region_cache.RegionCache] = None, summary: bool = False) -> List[Job]:
+    """
+    Splits the input into jobs for the worker pool.
+
+    With one process, every input is a job, and is streamed through a batch at a time.
+    Otherwise, the inputs are split into shards of records: a few per process, so the slow
+    ones don't hold everything up, and never more than BATCH_SIZE records, so that each one
+    comes back from the pool as a single batch. Standard input and compressed files can't be
+    split, and are always one job each.
+
+    Args:
+        paths: the input GFF files
+        cpus: the number of worker processes
+        profiles: the boundaries of each region
+        cache: passed on to every job
+        summary: whether the jobs work out summary rows
+    Returns:
+        a list of jobs for extract_job, in output order
+    """
+    if cpus <= 1:
+        return [Job(path, None, profiles, cache, summary) for path in paths]
+
+    indexed = [(path, None if streams.is_stream(path) else index_gff(path)) for path in paths]
+    n_records = sum(len(records) for _, records in indexed if records is not None)
+    shard_size = min(BATCH_SIZE, max(1, -(-n_records // (cpus * 4)))) # ceiling division
+
+    jobs: List[Job] = []
+    for path, records in indexed:
+        if records is None:
+            jobs.append(Job(path, None, profiles, cache, summary))
+            continue
+        # shards never cross files, so the output stays in input order
+        jobs += [Job(path, records[i:i + shard_size], profiles, cache, summary) for i in range(0, len(records), shard_size)]
+    return jobs
+
+def main(argv: Optional[Sequence[str]] = None):
     """Main CLI entry point for extract-control.py"""
-    args = get_params()
-
-    # make a new file, either forcing overwrite of the old file or not, depending on the setting.
-    with open(args.input, "r") as seq_file, open(args.output, "w" if args.force else "x") as out_file:
-
-        # highest to lowest priority, e.x. 12S is preferred to 12S (partial)
-        bound_start = ["mtRNA-Ile(gat)", "mtRNA-Ile(aat)"]
-        bound_end = ["12S ribosomal RNA", "12S ribosomal RNA (partial)"]
-        bound_end_strand = -1 # 1 positive, -1 negative strand. This is used to check for the reverse complement.
-        # anchors are basically only for tRNAs as boundaries because tRNAs are easy to copy and move,
-        # and are sometimes just totally mis-annotated when done automatically.
-        # So we use a protein coding gene, preferably large so it's harder to translocate, but generally just the closest.
-        # Then we find the closest tRNA to that gene and use that.
-        # IF NO ANCHOR IS GIVEN OR FOUND, it just uses the first occurence of the highest priority bound marker
-        # start/end are relative to the orientation on the stand. The start is the beginnig of the gene, not necessarily the bfirst numbered nt
-        bound_start_anchor = [("NADH-ubiquinone oxidoreductase chain 2","start"),("12S ribosomal RNA","start"), ("12S ribosomal RNA (partial)","start")]
-#nadh2start +
-        # through every sequence record in the gff
-        for rec in GFF.parse(seq_file):
-            # Make a dictionary called prod_features containing SeqFeature objects where the key is the product name
-            # and the value is a list of features that contain the same product tags.
-            prod_features: Dict[str, SeqFeature] = [f for f in rec.features if 'product' in f.qualifiers]
-
-            start_anchor_annots = [f for f in prod_features if f.qualifiers['product'][0] in bound_start_anchor[0]]
-            start_annots = get_features(prod_features, bound_start)
-            end_annots = get_features(prod_features, bound_end)
-
-            s_anchor_loc = find_anchor(bound_start_anchor, start_anchor_annots)
-
-            # through every possible start/end bound
-            start_annot = find_bound(len(rec), start_annots, s_anchor_loc)
-            end_annot = end_annots[0] if len(end_annots) > 0 else None
-
-            # get the sequence
-            out_seq = parse_seq(rec, start_annot, end_annot, bound_end_strand)
-
-            # print it out to the file
-            out_file.write(f">{rec.id}_cont_reg\n{out_seq}\n")
+    args = get_params(argv)
+
+    if args.metrics:
+        METRICS.enable()
+
+    profiles = load_profiles(args.profiles) if args.profiles else [CONTROL_REGION]
+    cache = region_cache.RegionCache(args.cache, args.cache_size * 2**20) if args.cache else None
+    jobs = make_jobs(args.input, args.cpus, profiles, cache, bool(args.summary))
+
+    # one output per region, or just the named output if there's only one region
+    out_paths = ([args.output] if len(profiles) == 1
+                 else [region_output_path(args.output, prof.name) for prof in profiles])
+
+    # make new files, either forcing overwrite of the old files or not, depending on the setting.
+    with contextlib.ExitStack() as stack:
+        out_files = [stack.enter_context(streams.open_output(path, args.force)) for path in out_paths]
+        summary = stack.enter_context(SummaryWriter(args.summary, args.force)) if args.summary else None
+        unique_files = []
+        if args.unique:
+            # named per region the same way as the outputs
+            unique_paths = ([(args.unique, args.members)] if len(profiles) == 1
+                            else [(region_output_path(args.unique, prof.name), region_output_path(args.members, prof.name))
+                                  for prof in profiles])
+            unique_files = [stack.enter_context(UniqueWriter(fasta, members, args.force)) for fasta, members in unique_paths]
+
+        if args.cpus <= 1 or len(jobs) <= 1:
+            batches = (batch for job in jobs for batch in extract_job(job))
+        else:
+            pool = stack.enter_context(multiprocessing.Pool(
+                args.cpus, initializer=METRICS.enable if METRICS.enabled else None))
+            batches = pooled_batches(pool, jobs)
+
+        for out_seqs, rows in batches:
+            with METRICS.stage("write"):
+                for out_file, region in zip(out_files, out_seqs):
+                    out_file.write(region)
+            if unique_files:
+                with METRICS.stage("dedup"):
+                    for unique_file, region in zip(unique_files, out_seqs):
+                        unique_file.write(region)
+            if summary is not None:
+                with METRICS.stage("write_summary"):
+                    summary.write(rows)
+
+    # only once everything's done, so nothing this run needs gets evicted
+    if cache is not None:
+        with METRICS.stage("cache_evict"):
+            cache.evict()
+
+    if args.metrics:
+        METRICS.write(args.metrics)
 
 if __name__ == '__main__':
     main()
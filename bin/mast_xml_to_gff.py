@@ -16,110 +16,501 @@
 #
 
 """
-mast-annotate.py --mast [mast].xml > [output].gff
+mast-annotate.py --input [mast].xml > [output].gff
 
 Takes a MAST output .xml file and makes a gff annotation file out of it.
+The input and output can be "-" (the default) for standard input/output, and
+either can be gzipped (see streams.py).
+
+With --fasta, it also does bind_gff_to_fasta.py's job in the same pass: the
+annotations get a ##FASTA section of the given sequences, either in the output
+itself or in a second output (--bound-output), without reading the annotations
+back in.
+
+With --members, MAST only searched one representative of each distinct sequence
+(see extract_control.py --unique), and the hits are copied to every member.
+
+With --cpus, a plain input is split into shards of whole <sequence> elements, which
+are converted in parallel and written out in order, exactly as one process would.
 """
 
+# the library types in the annotations aren't imported until they're needed (see load_libraries)
+from __future__ import annotations
 
 import argparse
-from bs4 import BeautifulSoup
+import contextlib
+import heapq
+import io
+import mmap
+import multiprocessing
+import re
+import urllib.parse
+
+from metrics import Metrics
+import streams
 
-from BCBio import GFF
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-from Bio.SeqFeature import SeqFeature, FeatureLocation
+from typing import TYPE_CHECKING, BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, TextIO, Tuple, Union
 
-from typing import List, TYPE_CHECKING
-# This is otherwise unnecessary, but has to be explicitly imported for type checking
 if TYPE_CHECKING:
-    from bs4.element import Tag
+    from lxml import etree
+    from Bio.SeqRecord import SeqRecord
+
+
+# only collects anything with --metrics
+METRICS = Metrics("mast_xml_to_gff.py")
+
+# lxml and Biopython are slow to import next to the work done on a small MAST file, so
+# they're only imported by load_libraries, once something needs them (--help never does).
+LIBRARIES_LOADED = False
+etree = Seq = SeqRecord = SeqFeature = FeatureLocation = None
+
+def load_libraries():
+    """Imports lxml and Biopython, the first time it's called."""
+    global LIBRARIES_LOADED, etree, Seq, SeqRecord, SeqFeature, FeatureLocation
+    if LIBRARIES_LOADED:
+        return
+
+    from lxml import etree
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    from Bio.SeqFeature import SeqFeature, FeatureLocation
+
+    LIBRARIES_LOADED = True
+
+# the start of every <sequence> element (but not <sequences>)
+SEQUENCE_TAG = re.compile(rb"<sequence[\s>]")
+
+# what each shard process needs to convert its shards (see init_shard_worker)
+SHARD_STATE: Optional[Tuple[str, List[Dict[str, str]], Optional[float], Optional[int], Optional[Dict[str, List[str]]]]] = None
+
 
+class MotifHit(NamedTuple):
+    """One MAST hit, ready to be written out."""
+    start: int # 0 indexed, like biopython
+    end: int
+    strand: int
+    name: str
+    pvalue: str # as written by MAST, so it goes back out unchanged
 
-def get_params():
-    """Gets command line arguments. Returns them."""
+
+def get_params(argv: Optional[Sequence[str]] = None):
+    """Gets command line arguments (from sys.argv, unless they're given). Returns them."""
     parser = argparse.ArgumentParser(description="""
         Takes a MAST output .xml file and makes a gff annotation file out of it.
         """.strip())
 
-    parser.add_argument("--input", help="The motif.xml file to be worked on.")
-    parser.add_argument("--output", help="The output destination (usually a .gff)")
+    parser.add_argument("--input", default="-", help="The motif.xml file to be worked on, optionally gzipped. Defaults to standard input.")
+    parser.add_argument("--output", default="-", help="The output destination (usually a .gff, or .gff.gz to compress it). Defaults to standard output.")
     parser.add_argument("--force", action="store_true", help="Overwrites the output if it already exists.")
+    parser.add_argument("--metrics", help="Append per-stage timings and per-sequence counters to this file, as JSON lines.")
+    parser.add_argument("--max-pvalue", type=float, help="Only keep hits with a p-value at or below this.")
+    parser.add_argument("--top-k", type=int, help="Only keep the best (lowest p-value) k hits in each sequence.")
+    parser.add_argument("--cpus", type=int, default=1, help="""
+        Number of processes to convert with. The sequences are split into shards that are
+        converted in parallel, and written out in their original order. Only for plain
+        files: standard input and gzipped inputs are converted in one pass.
+        """.strip())
+    parser.add_argument("--members", help="""
+        The table of representatives and members from extract_control.py --members, if MAST
+        only searched the representatives. Every member gets its representative's hits.
+        """.strip())
+    parser.add_argument("--fasta", help="""
+        The sequences MAST searched (the control regions). If given, they're added to the
+        annotations as a ##FASTA section, like bind_gff_to_fasta.py does.
+        """.strip())
+    parser.add_argument("--bound-output", help="""
+        With --fasta, write the annotations with the ##FASTA section here, and leave just
+        the annotations in --output. Otherwise, --output gets both.
+        """.strip())
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.bound_output and not args.fasta:
+        parser.error("--bound-output needs --fasta.")
+    return args
 
-def get_xml_data(xml_path: str) -> BeautifulSoup:
+def iter_xml_data(xml_path: Union[str, BinaryIO]) -> Iterator["etree._Element"]:
     """
-    Gets the XML data from the file and closes it nicely, returning the output
+    Streams the <motif> and <sequence> elements out of a MAST output file, in document order.
+
+    Each element is complete when it's yielded, and cleared (along with everything before
+    it) as soon as the caller is done with it, so memory use doesn't grow with the file.
 
     Args:
-        xml_path: a string pointing to the location of an xml object. Note: cannot be HTML becase of the 'lxml' option
+        xml_path: a string pointing to the location of a mast.xml file, "-" for standard input,
+            or an open binary file
     Returns:
-        BeautifulSoup object with the xml data
+        an iterator of lxml elements
     """
-    with open(xml_path) as mast_file:
-        return BeautifulSoup(mast_file, 'lxml')
+    load_libraries()
+    with streams.open_input(xml_path, text=False) as xml_file:
+        for _, elem in etree.iterparse(xml_file, events=("end",), tag=("motif", "sequence"), huge_tree=True):
+            yield elem
+
+            # drop the element and any finished siblings before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
-def get_seq_info(xml_path: str) -> List[SeqRecord]:
+def iter_mast_hits(xml_path: Union[str, BinaryIO], max_pvalue: Optional[float] = None, top_k: Optional[int] = None,
+                   motifs: Optional[List[Dict[str, str]]] = None) -> Iterator[Tuple[str, int, List[MotifHit]]]:
     """
-    Get the information out of a mast.xml file and return a list of annotated sequence objects
+    Streams the hits out of a mast.xml file, one <sequence> at a time.
+
+    The <motif> table comes before the sequences in MAST output, so it's read first and
+    the hits in each sequence are looked up in it as the sequences go past. Hits are
+    filtered as they're read, so the ones that are thrown away are never built.
 
     Args:
-        xml_path: a string noting the location of the file path
+        xml_path: a string noting the location of the file path, or an open binary file
+        max_pvalue: only keep hits with a p-value at or below this
+        top_k: only keep the k hits with the lowest p-values in each sequence (ties go to the earlier hit)
+        motifs: the motif table, if it isn't in the file (see scan_mast_xml)
     Returns:
-        a list of BioPython sequence records
+        an iterator of (sequence name, sequence length, hits in file order)
+    """
+    mot: List[Dict[str, str]] = list(motifs or [])  # motifs
+
+    for elem in METRICS.timed("xml_parse", iter_xml_data(xml_path)):
+        # grab attributes from all the motif tags
+        if elem.tag == "motif":
+            # make a new object in the table
+            mot.append(dict(elem.attrib))
+            continue
+
+        with METRICS.stage("feature_build"):
+            hits = resolve_hits(elem, mot, max_pvalue, top_k)
+        yield elem.get("name"), int(elem.get("length")), hits
+
+def scan_mast_xml(path: str, n_shards: int) -> Tuple[List[Dict[str, str]], List[Tuple[int, int]]]:
+    """
+    Does a quick pass over a MAST output file to split it up for convert_shard.
+
+    The <motifs> table is parsed on its own, and the <sequence> elements are found by
+    searching the file's bytes for their start tags, without parsing them.
+
+    Args:
+        path: a plain (not compressed) mast.xml file
+        n_shards: about how many shards to split the sequences into
+    Returns:
+        (the attributes of each <motif>, in order; the byte ranges of the shards, in file order)
+    """
+    load_libraries()
+    with open(path, "rb") as xml_file, mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        mot: List[Dict[str, str]] = []
+        motifs_start = buf.find(b"<motifs")
+        motifs_end = buf.find(b"</motifs>", max(motifs_start, 0))
+        if motifs_start >= 0 and motifs_end >= 0:
+            motifs_end += len(b"</motifs>")
+            motifs = etree.fromstring(buf[motifs_start:motifs_end], etree.XMLParser(huge_tree=True))
+            mot = [dict(elem.attrib) for elem in motifs.iter("motif")]
+        else:
+            motifs_end = 0
+
+        seqs_end = buf.find(b"</sequences>", motifs_end)
+        if seqs_end < 0:
+            return mot, []
+        starts = [match.start() for match in SEQUENCE_TAG.finditer(buf, motifs_end, seqs_end)]
+
+    # whole sequences only, about the same number of bytes in each shard
+    spans: List[Tuple[int, int]] = []
+    target = max(1, (seqs_end - starts[0]) // n_shards) if starts else 1
+    shard_start = None
+    for start in starts:
+        if shard_start is None:
+            shard_start = start
+        elif start - shard_start >= target:
+            spans.append((shard_start, start))
+            shard_start = start
+    if shard_start is not None:
+        spans.append((shard_start, seqs_end))
+    return mot, spans
+
+def init_shard_worker(path: str, mot: List[Dict[str, str]], max_pvalue: Optional[float], top_k: Optional[int],
+                      members: Optional[Dict[str, List[str]]], metrics: bool):
+    """Sets up a shard process with everything that's the same for every shard (see convert_shard)."""
+    global SHARD_STATE
+    SHARD_STATE = (path, mot, max_pvalue, top_k, members)
+    # a forked process starts with a copy of what the parent collected, which the parent already has
+    METRICS.reset()
+    if metrics:
+        METRICS.enable()
+
+def convert_shard(span: Tuple[int, int]) -> Tuple[str, dict]:
+    """
+    Converts the <sequence> elements in one byte range of the file (from scan_mast_xml) to GFF3.
+
+    Returns:
+        (the GFF lines for those sequences, the metrics collected)
+    """
+    path, mot, max_pvalue, top_k, members = SHARD_STATE
+    with open(path, "rb") as xml_file, mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        # a whole document of just these sequences
+        shard = b"<sequences>" + buf[span[0]:span[1]] + b"</sequences>"
+
+    seqs = iter_mast_hits(io.BytesIO(shard), max_pvalue, top_k, motifs=mot)
+    if members is not None:
+        seqs = fan_out(seqs, members)
+    lines = []
+    for seq_name, seq_len, hits in seqs:
+        with METRICS.stage("gff_write"):
+            lines.append(format_hits(seq_name, seq_len, hits))
+    return "".join(lines), METRICS.drain()
+
+def write_gff_parallel(path: str, out_file: TextIO, cpus: int, max_pvalue: Optional[float] = None,
+                       top_k: Optional[int] = None, members: Optional[Dict[str, List[str]]] = None):
+    """
+    Writes MAST hits out as GFF3, converting shards of the file in a pool of processes.
+    The output is exactly what write_gff writes.
+
+    Args:
+        path: a plain (not compressed) mast.xml file
+        out_file: where to write
+        cpus: the number of processes
+        max_pvalue: only keep hits with a p-value at or below this
+        top_k: only keep the k hits with the lowest p-values in each sequence
+        members: from read_members, to give every member its representative's hits
+    """
+    with METRICS.stage("scan"):
+        # a few shards per process, so the slow ones don't hold everything up
+        mot, spans = scan_mast_xml(path, cpus * 4)
+
+    out_file.write("##gff-version 3\n")
+    with multiprocessing.Pool(cpus, initializer=init_shard_worker,
+                              initargs=(path, mot, max_pvalue, top_k, members, METRICS.enabled)) as pool:
+        # imap keeps the shards in file order
+        for text, shard_metrics in pool.imap(convert_shard, spans):
+            METRICS.merge(shard_metrics)
+            with METRICS.stage("write"):
+                out_file.write(text)
+
+def resolve_hits(seq_tag: "etree._Element", mot: List[Dict[str, str]], max_pvalue: Optional[float] = None,
+                 top_k: Optional[int] = None) -> List[MotifHit]:
+    """
+    Turns the <hit> tags under a <sequence> into hits, filtering them on the way.
+
+    Args:
+        seq_tag: a <sequence> element
+        mot: the attributes of each <motif>, in order
+        max_pvalue: only keep hits with a p-value at or below this
+        top_k: only keep the k hits with the lowest p-values (ties go to the earlier hit)
+    Returns:
+        the hits, in file order
+    """
+    # go through every hit under the sequence to find the actual motif locations.
+    # with top_k, this is a heap of the best hits so far, with the worst on top.
+    kept: List[Tuple[float, int, "etree._Element"]] = []
+    n_hits = 0
+    for i, hit_tag in enumerate(seq_tag.iter("hit")):
+        n_hits += 1
+        pvalue = float(hit_tag.get("pvalue"))
+        if max_pvalue is not None and pvalue > max_pvalue:
+            continue
+        if top_k is None:
+            kept.append((-pvalue, -i, hit_tag))
+        elif len(kept) < top_k:
+            heapq.heappush(kept, (-pvalue, -i, hit_tag))
+        elif top_k > 0:
+            heapq.heappushpop(kept, (-pvalue, -i, hit_tag))
+
+    hits: List[MotifHit] = []
+    for _, _, hit_tag in sorted(kept, key=lambda k: -k[1]): # back into file order
+        cur_motif = mot[int(hit_tag.get("idx"))]
+        pos = int(hit_tag.get("pos"))
+        hits.append(MotifHit(
+            start=pos-1, # MAST indexes at 1, biopython indexes at 0
+            end=pos+int(cur_motif["length"])-1,
+            strand=(-1 if hit_tag.get("rc") == "y" else 1),
+            # If the alt name is empty, just the name. Otherwise, altn+" "+name
+            name=" ".join(filter(None, [cur_motif.get("alt", ""), cur_motif["id"]])),
+            pvalue=hit_tag.get("pvalue")
+        ))
+
+    METRICS.record(sequence=seq_tag.get("name"), seq_len=int(seq_tag.get("length")), hits=n_hits, kept=len(hits))
+    return hits
+
+def read_members(path: str) -> Dict[str, List[str]]:
+    """
+    Reads a membership table (from extract_control.py --members).
+
+    Args:
+        path: the table: a header, then a tab separated representative and member per line
+    Returns:
+        a dictionary of representative name -> member names, in table order
+    """
+    members: Dict[str, List[str]] = {}
+    with streams.open_input(path) as members_file:
+        next(members_file, None) # the header
+        for line in members_file:
+            rep, member = line.rstrip("\n").split("\t")
+            members.setdefault(rep, []).append(member)
+    return members
+
+def fan_out(seqs: Iterable[Tuple[str, int, List[MotifHit]]],
+            members: Dict[str, List[str]]) -> Iterator[Tuple[str, int, List[MotifHit]]]:
+    """
+    Gives every member of a representative sequence the representative's hits.
+
+    >>> list(fan_out([("a", 10, [])], {"a": ["a", "b"]}))
+    [('a', 10, []), ('b', 10, [])]
+
+    Args:
+        seqs: (sequence name, sequence length, hits), as from iter_mast_hits
+        members: from read_members. Sequences that aren't in it are passed on as they are.
+    Returns:
+        an iterator of (member name, sequence length, hits), members in table order
     """
-    seqs: List[SeqRecord] = [] # sequences
-    mot: List[Tag] = []  # motifs
+    for seq_name, seq_len, hits in seqs:
+        for member in members.get(seq_name, [seq_name]):
+            yield member, seq_len, hits
 
-    # crack the input file open and look at it 👀
+def format_attribute(key: str, value: str) -> str:
+    """
+    Formats a GFF3 attribute, escaping the characters that mean something in the attribute column.
+
+    >>> format_attribute("Name", "ALT1 MOTIF1;x=y")
+    'Name=ALT1 MOTIF1%3Bx%3Dy'
+    """
+    return f"{key}={urllib.parse.quote(value.strip(), safe=':/ ')}"
 
-    xml: BeautifulSoup = get_xml_data(xml_path)
+class TeeWriter:
+    """Writes the same text to more than one file."""
 
-    # grab attributes from all the motif tags
-    for mot_tag in xml.find_all("motif"): # Can't annotate loop variable, these are Tag
-        # make a new object in the table
-        mot.append(mot_tag)
+    def __init__(self, *files: TextIO):
+        self.files = files
 
-    # grab all the sequence tags and get their names and lengths.
-    for seq_tag in xml.find_all("sequence"): # Can't annotate loop variable, these are Tag
-        seq = SeqRecord("A"*(int(seq_tag["length"])),seq_tag["name"])
-        seqs.append(seq)
+    def write(self, text: str):
+        for out_file in self.files:
+            out_file.write(text)
 
-        # then, go through every hit under each sequence to find the actual motif locations.
-        for hit_tag in seq_tag.find_all("hit"):
-            cur_motif: Tag = mot[int(hit_tag["idx"])]
+def write_gff(seqs: Iterable[Tuple[str, int, List[MotifHit]]], out_file: TextIO):
+    """
+    Writes MAST hits out as GFF3, one sequence at a time as they come in.
+
+    Args:
+        seqs: (sequence name, sequence length, hits), as from iter_mast_hits
+        out_file: where to write
+    """
+    out_file.write("##gff-version 3\n")
+    for seq_name, seq_len, hits in seqs:
+        with METRICS.stage("gff_write"):
+            write_hits(seq_name, seq_len, hits, out_file)
+
+def write_hits(seq_name: str, seq_len: int, hits: List[MotifHit], out_file: TextIO):
+    """
+    Writes the GFF3 lines for one sequence.
 
+    Args:
+        seq_name: the sequence name
+        seq_len: the sequence length
+        hits: the sequence's hits
+        out_file: where to write
+    """
+    out_file.write(format_hits(seq_name, seq_len, hits))
+
+def format_hits(seq_name: str, seq_len: int, hits: List[MotifHit]) -> str:
+    """
+    Formats the GFF3 lines for one sequence.
+
+    Args:
+        seq_name: the sequence name
+        seq_len: the sequence length
+        hits: the sequence's hits
+    Returns:
+        the lines, newlines and all
+    """
+    lines = []
+    if seq_len > 0:
+        lines.append(f"##sequence-region {seq_name} 1 {seq_len}\n")
+    for hit in hits:
+        lines.append("\t".join([
+            seq_name,
+            "MEME Suite",
+            "nucleotide_motif",
+            str(hit.start + 1), # 1-based indexing
+            str(hit.end),
+            ".",
+            "+" if hit.strand == 1 else "-",
+            ".",
+            ";".join([format_attribute("Name", hit.name), format_attribute("Note", "p-value:"+hit.pvalue)])
+        ]) + "\n")
+    return "".join(lines)
+
+def iter_seq_info(xml_path: Union[str, BinaryIO], max_pvalue: Optional[float] = None, top_k: Optional[int] = None) -> Iterator[SeqRecord]:
+    """
+    Streams annotated sequence objects out of a mast.xml file, one per <sequence>.
+
+    The records only know their sequence's length, not its contents.
+
+    Args:
+        xml_path: a string noting the location of the file path, or an open binary file
+        max_pvalue: only keep hits with a p-value at or below this
+        top_k: only keep the k hits with the lowest p-values in each sequence
+    Returns:
+        an iterator of BioPython sequence records
+    """
+    load_libraries()
+    for seq_name, seq_len, hits in iter_mast_hits(xml_path, max_pvalue, top_k):
+        seq = SeqRecord(Seq(None, seq_len), seq_name)
+        for hit in hits:
             # from this, we construct the annotations.
             qualifiers = {
                 "source": "MEME Suite",
-                "Note": "p-value:"+hit_tag["pvalue"],
-                # If the alt name is empty, just the name. Otherwise, altn+" "+name
-                "Name": " ".join(filter(None, [cur_motif.attrs.get("alt", ""), cur_motif["id"]]))
+                "Note": "p-value:"+hit.pvalue,
+                "Name": hit.name
             }
 
             # build the sequence feature object
             seq.features.append(
                 SeqFeature(
-                    FeatureLocation(
-                        int(hit_tag["pos"])-1, # MAST indexes at 1, biopython indexes at 0
-                        int(hit_tag["pos"])+int(cur_motif["length"])-1
-                    ),
+                    FeatureLocation(hit.start, hit.end, strand=hit.strand),
                     type="nucleotide_motif",
-                    strand=(-1 if hit_tag["rc"] == "y" else 1),
                     qualifiers=qualifiers
                 )
             )
+        yield seq
+
+def get_seq_info(xml_path: Union[str, BinaryIO]) -> List[SeqRecord]:
+    """
+    Get the information out of a mast.xml file and return a list of annotated sequence objects
 
-    return seqs
+    Args:
+        xml_path: a string noting the location of the file path, or an open binary file
+    Returns:
+        a list of BioPython sequence records
+    """
+    return list(iter_seq_info(xml_path))
 
-def main():
+def main(argv: Optional[Sequence[str]] = None):
     """Main CLI entry point for mast-annotate.py"""
-    args = get_params()
+    args = get_params(argv)
+    if args.metrics:
+        METRICS.enable()
+
+    # open the outfile and start writing the sequences to the file as they're parsed
+    with contextlib.ExitStack() as stack:
+        out_file = stack.enter_context(streams.open_output(args.output, args.force))
+        bound_file = None
+        if args.fasta:
+            bound_file = (stack.enter_context(streams.open_output(args.bound_output, args.force))
+                          if args.bound_output else out_file)
+
+        gff_file = TeeWriter(out_file, bound_file) if bound_file not in (None, out_file) else out_file
+        members = read_members(args.members) if args.members else None
+        if args.cpus > 1 and not streams.is_stream(args.input):
+            write_gff_parallel(args.input, gff_file, args.cpus, args.max_pvalue, args.top_k, members)
+        else:
+            seqs = iter_mast_hits(args.input, args.max_pvalue, args.top_k)
+            if members is not None:
+                seqs = fan_out(seqs, members)
+            write_gff(seqs, gff_file)
+
+        if bound_file is not None:
+            bound_file.write("##FASTA\n")
+            with METRICS.stage("copy_fasta"):
+                streams.append_input(args.fasta, bound_file)
 
-    # open the outfile and start writing the sequence list to the file
-    with open(args.output, "w" if args.force else "x") as out_file:
-        GFF.write(get_seq_info(args.input), out_file)
+    if args.metrics:
+        METRICS.write(args.metrics)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,160 @@
+"""
+metrics.py
+
+Opt-in timing and counters for the scripts in bin/. Nothing is measured unless
+a script is run with --metrics <file>, in which case it appends JSON lines to
+that file, one object per line:
+    + {"type": "record", ...}: counters for one record (sequence length, etc.)
+    + {"type": "stage", "stage": ..., "calls": ..., "wall_s": ..., "peak_rss_mib": ...}:
+        the total time spent in one stage of the script, and the peak RSS of the
+        process when it was last in that stage.
+    + {"type": "run", "wall_s": ..., "peak_rss_mib": ..., "argv": [...]}: the whole run.
+
+Every line also has the script name and process ID, so files from many Nextflow
+tasks can just be concatenated and aggregated.
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+
+from typing import Dict, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+
+
+def peak_rss_mib() -> float:
+    """The peak resident set size of this process so far, in MiB."""
+    # Linux carries ru_maxrss over from the parent, across fork and exec, so a small script
+    # started by a big process reports the parent's peak. VmHWM is just this process's.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return usage / (2**20 if sys.platform == "darwin" else 2**10)
+
+class Stage:
+    """Context manager that adds the time spent inside it to a stage."""
+
+    __slots__ = ("_metrics", "_name", "_start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.add_time(self._name, time.perf_counter() - self._start)
+        return False
+
+class NullStage:
+    """Context manager that does nothing, for when metrics are off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Metrics:
+    """
+    Collects per-stage timings and per-record counters for one script.
+
+    It starts off disabled, and everything is a no-op until enable() is called.
+    """
+
+    def __init__(self, script: str):
+        self.script = script
+        self.reset()
+
+    def reset(self):
+        """Throws away everything collected, turns collection off, and restarts the run clock."""
+        self.enabled = False
+        self.start = time.perf_counter()
+        # stage name -> [calls, seconds, peak RSS]
+        self.stages: Dict[str, List[float]] = {}
+        self.records: List[dict] = []
+
+    def enable(self):
+        """Turns on collection."""
+        self.enabled = True
+
+    def stage(self, name: str):
+        """
+        Times a block of code as part of a stage:
+
+            with METRICS.stage("parse"):
+                ...
+        """
+        return Stage(self, name) if self.enabled else NULL_STAGE
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        """Adds time to a stage directly."""
+        stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+        stage[0] += calls
+        stage[1] += seconds
+        stage[2] = max(stage[2], peak_rss_mib())
+
+    def timed(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        """Times how long an iterator takes to produce each item (e.g. a streaming parser) as a stage."""
+        if not self.enabled:
+            yield from items
+            return
+
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start, 0)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def record(self, **counters):
+        """Notes the counters for one record."""
+        if self.enabled:
+            self.records.append(counters)
+
+    def drain(self) -> dict:
+        """Takes everything collected so far, so a worker process can send it back to be merged."""
+        data = {"stages": self.stages, "records": self.records}
+        self.stages = {}
+        self.records = []
+        return data
+
+    def merge(self, data: dict):
+        """Adds what another Metrics collected (from drain()) to this one."""
+        for name, (calls, seconds, rss) in data["stages"].items():
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+            stage[2] = max(stage[2], rss)
+        self.records += data["records"]
+
+    def write(self, path: str):
+        """Appends everything collected, and a summary of the run, to a JSON lines file."""
+        common = {"script": self.script, "pid": os.getpid()}
+        with open(path, "a") as metrics_file:
+            lines = [json.dumps({"type": "record", **common, **counters}) for counters in self.records]
+            for name, (calls, seconds, rss) in self.stages.items():
+                lines.append(json.dumps({"type": "stage", **common, "stage": name, "calls": calls,
+                                         "wall_s": round(seconds, 6), "peak_rss_mib": round(rss, 2)}))
+            lines.append(json.dumps({"type": "run", **common, "wall_s": round(time.perf_counter() - self.start, 6),
+                                     "peak_rss_mib": round(peak_rss_mib(), 2), "argv": sys.argv[1:]}))
+            metrics_file.write("\n".join(lines) + "\n")
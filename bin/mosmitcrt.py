@@ -0,0 +1,194 @@
+"""
+mosmitcrt.py
+
+The pipeline's Python steps as a library, for callers that already have their
+sequences in memory (e.g. a service) and don't want to go through files and
+subprocesses to use them:
+
+    import mosmitcrt
+
+    for region in mosmitcrt.extract_regions(records):
+        print(region.fasta(), end="")
+
+    for gff in mosmitcrt.mast_gff(mast_xml_bytes):
+        ...
+
+Everything takes an iterable of Biopython records, or the contents of a file (a path,
+bytes, or an open binary file, gzipped or not), and hands the results back as a
+generator, so nothing is read or worked out until it's asked for. It's the same code
+the scripts run, so the results are the same as theirs.
+"""
+
+# the Biopython types in the annotations aren't imported until they're needed
+from __future__ import annotations
+
+import io
+
+from typing import TYPE_CHECKING, BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import extract_control
+import mast_xml_to_gff
+import streams
+
+# the types the API takes and returns, so callers only need to import this
+from extract_control import BoundaryProfile, CONTROL_REGION, RegionMatch, load_profiles # noqa: F401
+from mast_xml_to_gff import MotifHit # noqa: F401
+
+if TYPE_CHECKING:
+    from Bio.SeqRecord import SeqRecord
+
+# a file's contents: its path ("-" for standard input), the bytes themselves, or an open binary file
+Source = Union[str, bytes, BinaryIO]
+
+class Region(NamedTuple):
+    """One region cut out of one record."""
+    record: str # the record ID
+    name: str # the profile's name
+    sequence: str # empty if it wasn't found
+    summary: Dict[str, object] # how it was found (see extract_control.summary_row)
+
+    @property
+    def found(self) -> bool:
+        """Whether both boundaries were found."""
+        return self.summary["status"] == "ok"
+
+    def fasta(self) -> str:
+        """The region as a FASTA entry, the same as extract_control.py writes."""
+        return f">{self.record}_{self.name}\n{self.sequence}\n"
+
+def open_source(source: Source, text: bool = False):
+    """Opens a Source (see streams.open_input). Files that were already open are left open."""
+    return streams.open_input(io.BytesIO(source) if isinstance(source, bytes) else source, text)
+
+def unwrap_origin_features(rec: SeqRecord) -> SeqRecord:
+    """
+    Makes features that span the origin into what the extraction expects (see
+    extract_control.build_record): one location that starts near the end of the sequence
+    and ends past it. Most parsers give them as a join of the end and the start instead.
+
+    Args:
+        rec: a BioPython sequence record
+    Returns:
+        the record, or a copy of it with the features unwrapped if any needed it
+    """
+    extract_control.load_libraries()
+    seq_len = len(rec)
+    features = []
+    changed = False
+    for feat in rec.features:
+        parts = feat.location.parts
+        tails = [part for part in parts if int(part.end) == seq_len]
+        heads = [part for part in parts if int(part.start) == 0]
+        if len(parts) == 2 and tails and heads and tails[0] is not heads[0]:
+            feat = extract_control.SeqFeature(
+                extract_control.FeatureLocation(int(tails[0].start), seq_len + int(heads[0].end), strand=feat.location.strand),
+                type=feat.type,
+                qualifiers=feat.qualifiers
+            )
+            changed = True
+        features.append(feat)
+
+    if not changed:
+        return rec
+    return extract_control.SeqRecord(rec.seq, id=rec.id, name=rec.name, description=rec.description, features=features)
+
+def locate(rec: SeqRecord, profile: BoundaryProfile = CONTROL_REGION) -> RegionMatch:
+    """
+    Finds one region in a record: the anchor (find_anchor), the boundary features
+    (find_bound), and where that puts the region.
+
+    Args:
+        rec: a BioPython sequence record
+        profile: the boundaries of the region
+    Returns:
+        what was found, with None for anything that wasn't
+    """
+    rec = unwrap_origin_features(rec)
+    return extract_control.match_region(rec, extract_control.CircularIndex(len(rec), rec.features), profile)
+
+def cut(rec: SeqRecord, match: RegionMatch, profile: BoundaryProfile = CONTROL_REGION) -> str:
+    """
+    Cuts a region found by locate out of its record (see extract_control.parse_seq).
+
+    Returns:
+        the region's sequence, or "" if a boundary is missing
+    """
+    return extract_control.parse_seq(unwrap_origin_features(rec), match.start_annot, match.end_annot, profile.bound_end_strand)
+
+def extract_regions(records: Iterable[SeqRecord], profiles: Optional[List[BoundaryProfile]] = None,
+                    batch_size: int = 1) -> Iterator[Region]:
+    """
+    Finds every region in every record.
+
+    Args:
+        records: BioPython sequence records, with their sequences and product qualifiers
+        profiles: the boundaries of each region. Defaults to just the control region.
+        batch_size: the number of records to cut regions out of at once. Bigger batches are
+            faster over many records, but nothing comes out until a whole batch has gone in.
+    Returns:
+        an iterator of regions, in record then profile order
+    """
+    profiles = profiles or [CONTROL_REGION]
+    for entries in extract_control.iter_regions(map(unwrap_origin_features, records), profiles, batch_size):
+        for entry, row in entries:
+            # the entry is ">record_region\nsequence\n"
+            yield Region(str(row["record"]), str(row["region"]), entry.split("\n")[1], row)
+
+def extract_gff(source: Source, profiles: Optional[List[BoundaryProfile]] = None,
+                batch_size: int = extract_control.BATCH_SIZE) -> Iterator[Region]:
+    """
+    Finds every region in a Prokka style GFF file (annotations, then a ##FASTA section),
+    the same as extract_control.py. Files on disk are read through a memory map.
+
+    Args:
+        source: the GFF file
+        profiles: the boundaries of each region. Defaults to just the control region.
+        batch_size: see extract_regions
+    Returns:
+        an iterator of regions, in record then profile order
+    """
+    profiles = profiles or [CONTROL_REGION]
+    products = extract_control.wanted_products(profiles)
+    if isinstance(source, str) and not streams.is_stream(source):
+        yield from extract_regions(extract_control.read_gff_file(source, products), profiles, batch_size)
+        return
+
+    with open_source(source, text=True) as gff_file:
+        yield from extract_regions(extract_control.read_gff_records(gff_file, products), profiles, batch_size)
+
+def mast_hits(source: Source, max_pvalue: Optional[float] = None, top_k: Optional[int] = None,
+              members: Optional[Dict[str, List[str]]] = None) -> Iterator[Tuple[str, int, List[MotifHit]]]:
+    """
+    Streams the hits out of MAST's XML output (see mast_xml_to_gff.iter_mast_hits).
+
+    With members (see mast_xml_to_gff.read_members), MAST only searched representative
+    sequences, and each one's hits are given to all of its members.
+
+    Returns:
+        an iterator of (sequence name, sequence length, hits)
+    """
+    with open_source(source) as xml_file:
+        seqs = mast_xml_to_gff.iter_mast_hits(xml_file, max_pvalue, top_k)
+        yield from seqs if members is None else mast_xml_to_gff.fan_out(seqs, members)
+
+def mast_records(source: Source, max_pvalue: Optional[float] = None, top_k: Optional[int] = None) -> Iterator[SeqRecord]:
+    """
+    Streams annotated records out of MAST's XML output, one per sequence (see mast_xml_to_gff.get_seq_info).
+
+    Returns:
+        an iterator of BioPython sequence records, which only know their sequence's length
+    """
+    with open_source(source) as xml_file:
+        yield from mast_xml_to_gff.iter_seq_info(xml_file, max_pvalue, top_k)
+
+def mast_gff(source: Source, max_pvalue: Optional[float] = None, top_k: Optional[int] = None,
+             members: Optional[Dict[str, List[str]]] = None) -> Iterator[str]:
+    """
+    Converts MAST's XML output to GFF3, the same as mast_xml_to_gff.py.
+
+    Returns:
+        an iterator of the GFF text: the header, then the lines for each sequence
+    """
+    yield "##gff-version 3\n"
+    for seq_name, seq_len, hits in mast_hits(source, max_pvalue, top_k, members):
+        yield mast_xml_to_gff.format_hits(seq_name, seq_len, hits)
@@ -0,0 +1,123 @@
+"""
+region_cache.py
+
+A content-addressed cache of extracted regions on disk, for reruns over mostly the
+same genomes. Each entry is one file, named after the hash of everything that went
+into it (see key()), so an entry can never be out of date: if anything changes, the
+key does too, and the old entry just stops being used until it's evicted.
+
+It's safe for any number of processes to share one cache folder:
+    + Entries are written to a temporary file and renamed into place, so nobody ever
+        reads half an entry.
+    + An entry disappearing (another process evicting it) is just a miss.
+    + Reading an entry bumps its modification time, which is what evict() uses to
+        throw out the least recently used entries first.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+
+from typing import List, Optional, Tuple
+
+# temporary files older than this were left behind by a process that died, and get cleaned up
+STALE_TMP_S = 3600
+
+def key(*parts: bytes) -> str:
+    """
+    Hashes some byte strings into a cache key. Each part is length prefixed, so moving
+    bytes from one part to the next changes the key.
+
+    >>> key(b"ab", b"c") == key(b"a", b"bc")
+    False
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+class RegionCache:
+    """An on-disk, size-bounded, least recently used cache of strings."""
+
+    def __init__(self, path: str, max_bytes: int):
+        """
+        Args:
+            path: the cache folder. It's made if it doesn't exist.
+            max_bytes: how big evict() lets the cache get
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def _entry(self, entry_key: str) -> str:
+        # split into subfolders, so no one folder ends up with millions of files
+        return os.path.join(self.path, entry_key[:2], entry_key[2:])
+
+    def get(self, entry_key: str) -> Optional[str]:
+        """Returns the entry for a key, or None if there isn't one."""
+        path = self._entry(entry_key)
+        try:
+            with open(path) as entry_file:
+                value = entry_file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def put(self, entry_key: str, value: str):
+        """Stores an entry, replacing it if it's already there."""
+        path = self._entry(entry_key)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        # hidden, so evict() can tell it apart from finished entries
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                tmp_file.write(value)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+            the number of entries deleted
+        """
+        now = time.time()
+        entries: List[Tuple[float, int, str]] = []
+        total = 0
+        for folder, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith(".tmp"):
+                    if now - stat.st_mtime > STALE_TMP_S:
+                        self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # someone else got to it first
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+split_gff.py --input [chunk].gff --outdir [folder]
+
+Splits a multi-record GFF file with a ##FASTA section (e.g. Prokka's output for a chunk
+of genomes) into one GFF file per record, each with its own annotations and sequence.
+Files are named after their record's ID, up to the first character that isn't a letter,
+a number, ".", "_" or "-" (the same as main.nf names its inputs).
+
+Records are found with extract_control.py's index, and copied as they are in the
+input, byte for byte.
+"""
+
+import argparse
+import mmap
+import os
+import re
+
+import extract_control
+from metrics import Metrics
+import streams
+
+from typing import Optional, Sequence
+
+# only collects anything with --metrics
+METRICS = Metrics("split_gff.py")
+
+def get_params(argv: Optional[Sequence[str]] = None):
+    """Gets the command line arguments (from sys.argv, unless they're given)"""
+    parser = argparse.ArgumentParser(description="""
+        Splits a multi-record GFF file with a ##FASTA section into one GFF file per record.
+        """.strip())
+    parser.add_argument("--input", required=True, help="The GFF file to split. It has to be a plain file, not compressed.")
+    parser.add_argument("--outdir", default=".", help="The folder to write the records to. Defaults to the current folder.")
+    parser.add_argument("--suffix", default=".gff", help="Added to the record name to make each file name. Defaults to .gff.")
+    parser.add_argument("--force", action="store_true", help="Overwrites the outputs if they already exist.")
+    parser.add_argument("--metrics", help="Append per-stage timings and per-record counters to this file, as JSON lines.")
+
+    args = parser.parse_args(argv)
+    if streams.is_stream(args.input):
+        parser.error("--input has to be a plain file, so it can be indexed.")
+    return args
+
+def record_file_name(seq_id: str) -> str:
+    """
+    The name a record's file is given: its ID up to the first character that doesn't belong in a file name.
+
+    >>> record_file_name("NC_028025.1 Anopheles gambiae")
+    'NC_028025.1'
+    >>> record_file_name("gi|12345|ref")
+    'gi'
+    """
+    return re.split(r"[^A-Za-z0-9._-]", seq_id, 1)[0] or "record"
+
+def sequence_length(fasta: bytes) -> int:
+    """
+    The length of the sequence in one FASTA entry.
+
+    >>> sequence_length(b">seq1 some description\\nACGT\\nAC\\n")
+    6
+    """
+    seq = fasta[fasta.find(b"\n") + 1:]
+    return len(seq) - seq.count(b"\n") - seq.count(b"\r")
+
+def main(argv: Optional[Sequence[str]] = None):
+    """Main CLI entry point for split_gff.py"""
+    args = get_params(argv)
+    if args.metrics:
+        METRICS.enable()
+
+    with METRICS.stage("index"):
+        records = extract_control.index_gff(args.input)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    names = set()
+    # index_gff doesn't find anything in an empty file, which can't be mapped anyway
+    if records:
+        with open(args.input, "rb") as gff_file, mmap.mmap(gff_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for seq_id, feature_spans, (fasta_start, fasta_end) in records:
+                name = record_file_name(seq_id)
+                if name in names:
+                    raise ValueError(f"More than one record in {args.input} would be written to {name}{args.suffix}.")
+                names.add(name)
+
+                with METRICS.stage("write"):
+                    fasta = buf[fasta_start:fasta_end]
+                    seq_len = sequence_length(fasta)
+                    with open(os.path.join(args.outdir, name + args.suffix), "wb" if args.force else "xb") as out_file:
+                        out_file.write(f"##gff-version 3\n##sequence-region {seq_id} 1 {seq_len}\n".encode())
+                        for start, end in feature_spans:
+                            out_file.write(buf[start:end])
+                        out_file.write(b"##FASTA\n")
+                        out_file.write(fasta)
+                METRICS.record(record=seq_id, seq_len=seq_len, feature_bytes=sum(end - start for start, end in feature_spans))
+
+    if args.metrics:
+        METRICS.write(args.metrics)
+
+if __name__ == '__main__':
+    main()
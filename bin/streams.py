@@ -0,0 +1,287 @@
+"""
+streams.py
+
+Opening inputs and outputs for the scripts in bin/, so they can all be used in pipes
+and on compressed files:
+    + "-" means standard input or standard output.
+    + Compressed inputs (gzip or bgzip) are found by their contents, not their name,
+        and decompressed on the fly.
+    + Outputs ending in .gz or .bgz are compressed on the fly as BGZF (what bgzip
+        writes). BGZF is still plain gzip to anything that doesn't know about it, but it's
+        made of independent blocks, so the blocks are compressed by a pool of threads.
+    + Whole files are appended to outputs by the kernel (copy_file_range, or sendfile)
+        where it can, without passing through Python at all.
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import io
+import mmap
+import os
+import shutil
+import stat
+import struct
+import sys
+import zlib
+
+from typing import IO, Deque, Iterator, Union
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# the most uncompressed data in a BGZF block. Same as bgzip, so even incompressible data
+# fits in the 64 KiB a block is allowed to be.
+BGZF_BLOCK_SIZE = 0xff00
+# the empty block at the end of every BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+COMPRESSED_EXTENSIONS = (".gz", ".bgz")
+
+# for copies that can't be done by the kernel
+COPY_BUFFER_SIZE = 2**20
+
+def is_stream(path: str) -> bool:
+    """
+    Whether a path can't be read in place (memory mapped, seeked around in): standard input,
+    or a compressed file.
+    """
+    if path == "-":
+        return True
+    with open(path, "rb") as in_file:
+        return in_file.read(2) == GZIP_MAGIC
+
+def strip_compression(path: str) -> str:
+    """
+    Takes the compression extension off a file name, if it has one.
+
+    >>> strip_compression("regions.fasta.gz")
+    'regions.fasta'
+    """
+    for ext in COMPRESSED_EXTENSIONS:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+def compress_threads() -> int:
+    """The number of threads to compress with: however many CPUs this process may use."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def bgzf_block(data: bytes) -> bytes:
+    """Compresses up to BGZF_BLOCK_SIZE bytes into one BGZF block."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    # gzip header, with the BC extra field holding the size of the whole block, less 1
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Writes BGZF to a binary file, compressing blocks in a thread pool.
+
+    zlib lets go of the GIL while it compresses, so the blocks really are compressed in
+    parallel. Blocks are written out in order, and only a few per thread are held in
+    memory at once.
+    """
+
+    def __init__(self, out_file: IO[bytes], threads: int = 1):
+        super().__init__()
+        self._out_file = out_file
+        self._buffer = bytearray()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max(1, threads))
+        self._pending: Deque[concurrent.futures.Future] = collections.deque()
+        self._max_pending = 4 * max(1, threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._pool.submit(bgzf_block, block))
+        while len(self._pending) > self._max_pending:
+            self._out_file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._out_file.write(self._pending.popleft().result())
+            self._out_file.write(BGZF_EOF)
+        finally:
+            self._pool.shutdown()
+            super().close()
+
+@contextlib.contextmanager
+def open_input(source: Union[str, IO[bytes]], text: bool = True) -> Iterator[IO]:
+    """
+    Opens an input file, standard input for "-", decompressing it if it's gzipped.
+
+    Args:
+        source: the file, "-", or an already open binary file (which is left open)
+        text: open it as text, otherwise as bytes
+    Returns:
+        a context manager giving the open file
+    """
+    if isinstance(source, str):
+        raw = sys.stdin.buffer if source == "-" else open(source, "rb")
+    else:
+        # looking for the gzip header needs peek, which only buffered files have
+        raw = source if hasattr(source, "peek") else io.BufferedReader(source)
+
+    try:
+        if raw.peek(2)[:2] == GZIP_MAGIC:
+            # closing it doesn't close raw
+            with gzip.GzipFile(fileobj=raw, mode="rb") as gz_file:
+                yield io.TextIOWrapper(gz_file) if text else gz_file
+        elif not text:
+            yield raw
+        elif raw is sys.stdin.buffer:
+            yield sys.stdin
+        else:
+            text_file = io.TextIOWrapper(raw)
+            try:
+                yield text_file
+            finally:
+                # so it doesn't close raw when it's garbage collected
+                text_file.detach()
+    finally:
+        if isinstance(source, str) and source != "-":
+            raw.close()
+        elif raw is not source and raw is not sys.stdin.buffer:
+            raw.detach()
+
+@contextlib.contextmanager
+def open_output(path: str, force: bool = False, text: bool = True) -> Iterator[IO]:
+    """
+    Opens an output file, standard output for "-", compressing it if the name ends in .gz or .bgz.
+
+    Args:
+        path: the file, or "-"
+        force: overwrite the file if it already exists, otherwise it's an error
+        text: open it as text, otherwise as bytes
+    Returns:
+        a context manager giving the open file
+    """
+    if path == "-":
+        out_file = sys.stdout if text else sys.stdout.buffer
+        try:
+            yield out_file
+        finally:
+            out_file.flush()
+        return
+
+    with open(path, "wb" if force else "xb") as raw:
+        if not path.endswith(COMPRESSED_EXTENSIONS):
+            if not text:
+                yield raw
+                return
+            with io.TextIOWrapper(raw) as text_file:
+                yield text_file
+            return
+
+        # closed from the outside in: the text layer, the buffer, then the BGZF writer
+        with io.BufferedWriter(BgzfWriter(raw, compress_threads()), BGZF_BLOCK_SIZE) as bgzf_file:
+            if not text:
+                yield bgzf_file
+                return
+            with io.TextIOWrapper(bgzf_file) as text_file:
+                yield text_file
+
+def kernel_copy(in_fd: int, out_fd: int, start: int, end: int) -> int:
+    """
+    Copies bytes start..end of a regular file onto the end of what's been written to out_fd,
+    in the kernel. Tries copy_file_range (between files, Python 3.8+), then sendfile (to
+    anything, on Linux).
+
+    Returns:
+        where it got to, which is less than end if neither system call works here
+    """
+    copied = start
+    calls = []
+    if hasattr(os, "copy_file_range"):
+        calls.append(lambda count: os.copy_file_range(in_fd, out_fd, count, copied))
+    if hasattr(os, "sendfile"):
+        calls.append(lambda count: os.sendfile(out_fd, in_fd, copied, count))
+
+    for call in calls:
+        try:
+            while copied < end:
+                count = call(end - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            # not supported for these files (e.g. across filesystems, or to a pipe). Try the next one.
+            continue
+        if copied >= end:
+            break
+    return copied
+
+def copy_stream(in_file: IO[bytes], out_file: IO[bytes]):
+    """
+    Copies the rest of a binary input to a binary output.
+
+    If the input is a regular file and the output is a real file descriptor, the copy is
+    done by the kernel (see kernel_copy). Otherwise, or for whatever the kernel can't do,
+    it's copied through a large buffer.
+    """
+    try:
+        if isinstance(in_file, gzip.GzipFile):
+            raise io.UnsupportedOperation("the file descriptor is the compressed data")
+        in_fd, out_fd = in_file.fileno(), out_file.fileno()
+        in_stat = os.fstat(in_fd)
+        start = in_file.tell()
+    except (OSError, ValueError):
+        # io.UnsupportedOperation is both
+        in_stat = None
+
+    if in_stat is not None and stat.S_ISREG(in_stat.st_mode):
+        # anything still buffered has to go out first, so the kernel's copy lands after it
+        out_file.flush()
+        in_file.seek(kernel_copy(in_fd, out_fd, start, in_stat.st_size))
+
+    shutil.copyfileobj(in_file, out_file, COPY_BUFFER_SIZE)
+
+def append_input(path: str, out_file: IO):
+    """
+    Copies a whole input (see open_input) onto the end of an output, which can be text or binary.
+
+    Text outputs are copied to as bytes, through the binary file under them, unless there
+    isn't one (e.g. a StringIO).
+    """
+    if isinstance(out_file, io.TextIOBase):
+        out_file.flush()
+        if not hasattr(out_file, "buffer"):
+            with open_input(path) as in_file:
+                shutil.copyfileobj(in_file, out_file, COPY_BUFFER_SIZE)
+            return
+        out_file = out_file.buffer
+
+    with open_input(path, text=False) as in_file:
+        copy_stream(in_file, out_file)
+
+def has_fasta_section(path: str) -> bool:
+    """
+    Whether a GFF file already has a ##FASTA section, found by searching the file's bytes
+    for the marker rather than reading it line by line. Compressed files and standard input
+    can't be searched in place, so they're taken not to.
+    """
+    if is_stream(path):
+        return False
+    with open(path, "rb") as gff_file:
+        if os.fstat(gff_file.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(gff_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return buf[:7] == b"##FASTA" or buf.find(b"\n##FASTA") >= 0
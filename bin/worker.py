@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+worker.py serve [--socket <path>]
+worker.py run --socket <path> <script> [script arguments]
+
+Runs the other scripts in bin/ from one long-lived Python process, so each job
+doesn't pay for starting Python and importing Biopython and lxml all over again.
+
+    + serve --socket <path>: loads everything once, then listens on a Unix socket.
+        Each connection is one job, run in a fork of the server, so jobs run in
+        parallel and can't leave anything behind for the next one.
+    + serve (no socket): reads jobs from standard input, one JSON object per line,
+        and runs them one at a time. A JSON result line is written to standard
+        output for each one.
+    + run: the client. Sends one job to a server and waits for it to finish, then
+        passes on its output and exit status, as if the script had been run directly.
+        It only imports the standard library, so it starts about as fast as Python does.
+
+A job looks like:
+    {"script": "extract_control.py", "args": ["--input", "in.gff", ...], "cwd": "/where/to/run/it"}
+and its result like:
+    {"status": 0, "stdout": "...", "stderr": "..."}
+Jobs can't read standard input, so "-" isn't a valid input for them (and neither is
+leaving out an input that defaults to it). That's an error, not an empty input.
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+
+from typing import Dict, Iterable, List, Optional
+
+# the scripts that can be run as jobs
+SCRIPTS = ["extract_control", "mast_xml_to_gff", "bind_gff_to_fasta", "split_gff"]
+
+def get_params():
+    """Returns the command line arguments."""
+    parser = argparse.ArgumentParser(description="""
+        Runs the scripts in bin/ from one long-lived process, so the libraries are only
+        imported once.
+        """.strip())
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    serve = commands.add_parser("serve", help="Start a worker.")
+    serve.add_argument("--socket", help="""
+        Listen on this Unix socket. Without it, jobs are read from standard input as JSON lines.
+        """.strip())
+
+    run = commands.add_parser("run", help="Send a job to a worker, and wait for it.")
+    run.add_argument("--socket", required=True, help="The worker's Unix socket.")
+    run.add_argument("script", choices=SCRIPTS + [script + ".py" for script in SCRIPTS], help="The script to run.")
+    run.add_argument("args", nargs=argparse.REMAINDER, help="The script's arguments.")
+
+    return parser.parse_args()
+
+def script_module(script: str):
+    """The module for a script name, with or without the .py."""
+    name = script[:-3] if script.endswith(".py") else script
+    if name not in SCRIPTS:
+        raise ValueError(f"Unknown script '{script}'. Expected one of: {', '.join(SCRIPTS)}.")
+    return importlib.import_module(name)
+
+def load_scripts():
+    """Imports every script, and the libraries they use, ahead of the first job."""
+    for name in SCRIPTS:
+        module = script_module(name)
+        if hasattr(module, "load_libraries"):
+            module.load_libraries()
+
+class NoStdin(io.RawIOBase):
+    """
+    What jobs get for standard input. The worker's own standard input is the job stream
+    (or nothing, under a socket), so a job reading it would eat the jobs after it, or hang.
+    """
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        raise JobInputError("standard input isn't passed through worker.py. Give the job its inputs as files.")
+
+class JobInputError(OSError):
+    """A job tried to read standard input."""
+
+def run_job(job: Dict[str, object]) -> Dict[str, object]:
+    """
+    Runs one job in this process, as though its script had been run from the command line.
+
+    Args:
+        job: {"script": ..., "args": [...], "cwd": ...}. "cwd" defaults to the worker's.
+    Returns:
+        {"status": exit status, "stdout": ..., "stderr": ...}
+    """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status = 0
+    cwd, argv, stdin = os.getcwd(), sys.argv, sys.stdin
+    try:
+        sys.stdin = io.TextIOWrapper(io.BufferedReader(NoStdin()))
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                module = script_module(str(job["script"]))
+                os.chdir(str(job.get("cwd", cwd)))
+                # for the usage messages, and what --metrics says the arguments were
+                sys.argv = [module.__name__ + ".py"] + list(job.get("args", []))
+                # starts the run clock, and makes sure --metrics from an earlier job isn't still on
+                module.METRICS.reset()
+                module.main(list(job.get("args", [])))
+            except SystemExit as err:
+                # argparse errors, mostly. Same as what the interpreter does with the code.
+                if isinstance(err.code, int) or err.code is None:
+                    status = err.code or 0
+                else:
+                    print(err.code, file=sys.stderr)
+                    status = 1
+            except JobInputError as err:
+                print(f"{job['script']}: error: {err}", file=sys.stderr)
+                status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+    finally:
+        os.chdir(cwd)
+        sys.argv, sys.stdin = argv, stdin
+
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+def serve_stream(jobs: Iterable[str], out_file):
+    """Runs JSON line jobs one at a time, writing a JSON result line for each."""
+    for line in jobs:
+        if not line.strip():
+            continue
+        try:
+            result = run_job(json.loads(line))
+        except (ValueError, TypeError, KeyError) as err:
+            result = {"status": 1, "stdout": "", "stderr": f"Bad job {line.strip()!r}: {err}\n"}
+        out_file.write(json.dumps(result) + "\n")
+        out_file.flush()
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Runs the one job sent over a connection, and sends back the result."""
+
+    def handle(self):
+        line = self.rfile.readline().decode()
+        try:
+            result = run_job(json.loads(line))
+        except (ValueError, TypeError, KeyError) as err:
+            result = {"status": 1, "stdout": "", "stderr": f"Bad job {line.strip()!r}: {err}\n"}
+        self.wfile.write((json.dumps(result) + "\n").encode())
+
+class ForkingUnixServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """A Unix socket server that handles every connection in its own fork."""
+
+def serve_socket(path: str):
+    """Listens for jobs on a Unix socket until interrupted."""
+    # a socket left over from a worker that didn't exit cleanly
+    if os.path.exists(path):
+        os.remove(path)
+
+    # stop the same way on a kill as on ctrl-C, so the socket gets cleaned up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with ForkingUnixServer(path, JobHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+def send_job(path: str, script: str, args: List[str], cwd: Optional[str] = None) -> Dict[str, object]:
+    """
+    Sends a job to a worker and waits for the result.
+
+    Args:
+        path: the worker's Unix socket
+        script: the script to run
+        args: the script's arguments
+        cwd: where to run it. Defaults to the current folder.
+    Returns:
+        the job's result (see run_job)
+    """
+    job = {"script": script, "args": args, "cwd": cwd or os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall((json.dumps(job) + "\n").encode())
+        with conn.makefile("rb") as reply:
+            return json.loads(reply.readline().decode())
+
+def main():
+    """Main CLI entry point for worker.py"""
+    args = get_params()
+
+    if args.command == "run":
+        result = send_job(args.socket, args.script, args.args)
+        sys.stdout.write(result["stdout"])
+        sys.stderr.write(result["stderr"])
+        sys.exit(result["status"])
+
+    load_scripts()
+    if args.socket:
+        serve_socket(args.socket)
+    else:
+        serve_stream(sys.stdin, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,10 @@ def helpMessage() {
     --out                     Output folder name. Defaults to "pipe_out"
     --nomotif                 Overrides --motif and skips MAST and subsequent steps.
     --prokkaOpts              Extra prokka options. Must be wrapped in quotes.
+    --chunkSize               Number of genomes annotated per Prokka task. Defaults to 1.
+    --cache                   Folder to cache extracted control regions in, for reruns over mostly the same genomes.
+    --worker                  Unix socket of a running "worker.py serve", to run the Python steps through.
+    --metrics                 Write per-stage timings and per-record counters (JSON lines) to <out>/metrics.
   """.stripIndent()
 }
 
@@ -36,7 +40,14 @@ params.motif = null
 params.help = null
 params.nomotif = null
 params.prokkaOpts = ""
+params.chunkSize = 1
 params.monochrome = false
+params.metrics = false
+params.cache = null
+params.worker = null
+
+// the Python steps go through a long-lived worker if there is one, to skip the interpreter and import startup
+py = params.worker ? "worker.py run --socket ${params.worker} " : ""
 
 def summary = [:]
 if (workflow.revision)
@@ -49,7 +60,15 @@ if (params.nomotif)
   summary['Motif file']       = params.motif
 if (params.prokkaOpts)
   summary['Prokka options:']  = params.prokkaOpts
+if (params.chunkSize > 1)
+  summary['Chunk size']       = params.chunkSize
 summary['Output dir']         = params.out
+if (params.cache)
+  summary['Region cache']     = params.cache
+if (params.worker)
+  summary['Worker socket']    = params.worker
+if (params.metrics)
+  summary['Metrics']          = "${params.out}/metrics"
 summary['Launch dir']         = workflow.launchDir
 summary['Working dir']        = workflow.workDir
 summary['Script dir']         = workflow.projectDir
@@ -73,9 +92,9 @@ if (params.motif == null && !params.nomotif) {
 }
 
 
-// Split the sequences into their own processes.
+// Split the sequences into chunks of --chunkSize genomes, one Prokka task each.
 sequences_ch = Channel.fromPath(params.in)
-          .splitFasta(by: 1, file: true)
+          .splitFasta(by: params.chunkSize, file: true)
           .dump()
 
 // load up the reference motifs
@@ -85,7 +104,7 @@ if (!params.nomotif) {
   referenceMotifs_ch = Channel.empty()
 }
 
-// appends the sequence ID to the filename. Only takes the ID up until the first non-alphanumeric character that isn't '.', '_', or '-'.
+// appends the (first) sequence ID to the filename. Only takes the ID up until the first non-alphanumeric character that isn't '.', '_', or '-'.
 // This behaviour is to prevent illegal filenames.
 // The rest of the filename is maintained to ensure the output won't have any overlapping names.
 process giveFileNameFastaID {
@@ -108,54 +127,46 @@ process performProkka {
     mode: 'copy',
     saveAs: {filename ->
       fileOut = file(filename)
-      "${fileOut.getExtension()}/${fileOut.getName()}"
+      // the per-genome annotations split out of a chunk keep their own folder
+      filename.startsWith("records/") ? filename : "${fileOut.getExtension()}/${fileOut.getName()}"
     }
 
   input:
   file inp from renamedSequences_ch // <--- giveFileNameFastaID
 
   output:
-  file "**/*.gff" into annotatedSeqs_ch // ---> extractControlSeq
+  file "prokka-out/*.gff" into annotatedSeqs_ch // ---> extractControlSeqs
   file("**/*")
 
-  """
-  prokka --outdir prokka-out --force --prefix ${inp.baseName} --cpus ${task.cpus} --gcode 5 --kingdom mitochondria ${inp} ${params.prokkaOpts}
-  """
-
-
-}
-
-// extracts the control sequences
-process extractControlSeq {
-  publishDir "${params.out}/control-sequences/individual", mode: 'copy'
-
-  input:
-  file inp from annotatedSeqs_ch // <--- performProkka
-
-  output:
-  file fasta into combineControlSeq_ch // ---> combineControlSeqs
-
   script:
-  fasta = "${inp.baseName}_controlSeq.fasta"
+  // a chunk's annotations are also split up into one GFF per genome, named after it
+  split = params.chunkSize > 1 ? "${py}split_gff.py --input prokka-out/${inp.baseName}.gff --outdir records" : ""
 
   """
-  extract_control.py --input ${inp} --output ${fasta}
+  prokka --outdir prokka-out --force --prefix ${inp.baseName} --cpus ${task.cpus} --gcode 5 --kingdom mitochondria ${inp} ${params.prokkaOpts}
+  ${split}
   """
 
+
 }
 
-// concatenates the control sequences into a single file
-process combineControlSeqs {
-  publishDir "${params.out}/control-sequences", mode: 'copy'
+// extracts the control sequences from every annotation in one job, and writes them to a single file
+process extractControlSeqs {
+  publishDir "${params.out}/control-sequences", mode: 'copy', pattern: "*.{fasta,tsv}"
+  publishDir "${params.out}/metrics", mode: 'copy', pattern: "*.jsonl"
 
   input:
-  file "*.fasta" from combineControlSeq_ch.collect() // <--- extractControlSeqs
+  file "*" from annotatedSeqs_ch.collect() // <--- performProkka
 
   output:
-  file "all_sequences.fasta" into mast_ch, annotateContReg_ch // ---> split into (mast_ch -> findMotifs) and (annotateContReg_ch -> annotateMotifs)
+  file "all_sequences.fasta" into annotateContReg_ch // ---> annotateMotifs
+  file "unique_sequences.fasta" into mast_ch // ---> findMotifs, which only has to search each distinct sequence once
+  file "members.tsv" into members_ch // ---> annotateMotifs, to copy the hits back to every sequence
+  file "control_summary.tsv" // ---> output
+  file "*.jsonl" optional true // ---> output
 
   """
-  cat *.fasta > all_sequences.fasta
+  ${py}extract_control.py --input *.gff --output all_sequences.fasta --unique unique_sequences.fasta --members members.tsv --summary control_summary.tsv --cpus ${task.cpus} ${params.cache ? "--cache ${file(params.cache)}" : ""} ${params.metrics ? "--metrics extract_control.jsonl" : ""}
   """
 
 }
@@ -165,7 +176,7 @@ process findMotifs {
   publishDir params.out, mode: 'copy'
 
   input:
-  file inp from mast_ch // <--- combineControlSeqs
+  file inp from mast_ch // <--- extractControlSeqs
   file ref from referenceMotifs_ch // <--- --motifs (command line or defualt file)
 
   output:
@@ -178,24 +189,27 @@ process findMotifs {
 
 }
 
-// turns the mast annotations into .gff format, and makes a second file that has annotations and the sequences.
+// turns the mast annotations into .gff format, and makes a second file that has annotations and the sequences, in one pass.
 process annotateMotifs {
-  publishDir params.out, mode: 'copy'
+  publishDir params.out, mode: 'copy', pattern: "*.gff"
+  publishDir "${params.out}/metrics", mode: 'copy', pattern: "*.jsonl"
 
   input:
   file inp from annotateMotifs_ch // <--- findMotifs
-  file seqs from annotateContReg_ch // <--- input
+  file seqs from annotateContReg_ch // <--- extractControlSeqs
+  file members from members_ch // <--- extractControlSeqs
 
   output:
   file annot // ---> output
   file "annSeq.gff" // ---> output
+  file "*.jsonl" optional true // ---> output
 
   script:
   annot = "annotations.gff"
+  metrics = params.metrics ? "--metrics annotate.jsonl" : ""
 
   """
-  mast_xml_to_gff.py --input ${inp} --output ${annot} && \
-  bind_gff_to_fasta.py --gff ${annot} --fasta ${seqs} --output annSeq.gff
+  ${py}mast_xml_to_gff.py --input ${inp} --members ${members} --cpus ${task.cpus} --output ${annot} --fasta ${seqs} --bound-output annSeq.gff ${metrics}
   """
 
 }